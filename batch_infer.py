@@ -0,0 +1,164 @@
+"""
+Offline bulk inference.
+
+Streams sequences from a memory-mapped .npy or raw idx (MNIST format) file,
+scores them with a RwkvModel checkpoint in a pool of worker processes and
+writes logits and predictions into preallocated memory-mapped .npy files.
+Work is split into shards; a manifest records finished shards, so rerunning
+the same command resumes where an interrupted run stopped.
+
+    python batch_infer.py --checkpoint model.ckpt --input MNIST/raw/t10k-images-idx3-ubyte --out scores/
+    python batch_infer.py --checkpoint model.ckpt --input images.npy --out scores/ --workers 4 --threads 2
+
+uint8 inputs are scaled to [0, 1] like the training loader; any input is
+reshaped to (N, T, input_scan_dim).
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+
+from rwkv_model import RwkvModel
+
+# idx type codes, data is big-endian
+_IDX_DTYPES = {0x08: np.uint8, 0x09: np.int8, 0x0B: '>i2', 0x0C: '>i4', 0x0D: '>f4', 0x0E: '>f8'}
+
+
+def open_input(path):
+    """Read-only memory map of a .npy or uncompressed idx file"""
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    with open(path, 'rb') as f:
+        magic = int.from_bytes(f.read(4), 'big')
+        ndim = magic & 0xff
+        shape = tuple(int.from_bytes(f.read(4), 'big') for _ in range(ndim))
+    dtype = _IDX_DTYPES[(magic >> 8) & 0xff]
+    return np.memmap(path, dtype=dtype, mode='r', offset=4 + 4 * ndim, shape=shape)
+
+
+def _file_id(path):
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime}
+
+
+class Manifest:
+    """JSON record of the run's settings and finished shards, rewritten atomically"""
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved['settings'] != settings:
+                raise RuntimeError(f'{path} belongs to a run with different settings, use another --out')
+            self.done = set(saved['done'])
+
+    def mark(self, shard):
+        self.done.add(shard)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'settings': self.settings, 'done': sorted(self.done)}, f)
+        os.replace(tmp, self.path)
+
+
+_worker = {}
+
+
+def _init_worker(checkpoint, threads, input_path, out_dir, permutation):
+    torch.set_num_threads(threads)
+    model = RwkvModel.from_checkpoint(checkpoint).eval()
+    _worker.update(
+        model=model,
+        inputs=open_input(input_path),
+        logits=np.load(os.path.join(out_dir, 'logits.npy'), mmap_mode='r+'),
+        preds=np.load(os.path.join(out_dir, 'preds.npy'), mmap_mode='r+'),
+        permutation=None if permutation is None else torch.as_tensor(permutation),
+    )
+
+
+def _run_shard(shard, start, stop, batch_size):
+    model, inputs, permutation = _worker['model'], _worker['inputs'], _worker['permutation']
+    logits, preds = _worker['logits'], _worker['preds']
+    with torch.inference_mode():
+        for b in range(start, stop, batch_size):
+            e = min(b + batch_size, stop)
+            x = torch.from_numpy(np.asarray(inputs[b:e]))
+            x = x.float().div_(255) if x.dtype == torch.uint8 else x.float()
+            x = x.reshape(e - b, -1)
+            if permutation is not None:
+                x = x[:, permutation]
+            out = model(x.reshape(e - b, -1, model.input_scan_dim))
+            logits[b:e] = out.numpy()
+            preds[b:e] = out.argmax(1).numpy()
+    logits.flush()
+    preds.flush()
+    return shard
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checkpoint', required=True, help='SeqMNIST/RwkvModel checkpoint')
+    parser.add_argument('--input', required=True, help='.npy or raw idx file')
+    parser.add_argument('--out', required=True, help='output directory for logits.npy, preds.npy and manifest.json')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) // 2))
+    parser.add_argument('--threads', type=int, default=None, help='torch threads per worker, default cores / workers')
+    parser.add_argument('--batch-size', type=int, default=1024)
+    parser.add_argument('--shard-size', type=int, default=8192)
+    parser.add_argument('--permuted', action='store_true', help="apply SeqMNIST's permutation for --data-seed")
+    parser.add_argument('--data-seed', type=int, default=0)
+    args = parser.parse_args()
+
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    inputs = open_input(args.input)
+    N = len(inputs)
+    with open(args.checkpoint, 'rb') as f:
+        weights = hashlib.sha256(f.read()).hexdigest()
+    output_dim = RwkvModel.from_checkpoint(args.checkpoint).readout.out_features
+
+    permutation = None
+    if args.permuted:
+        # same permutation SeqMNIST draws for this data_seed
+        permutation = torch.randperm(28 * 28, generator=torch.Generator().manual_seed(args.data_seed)).tolist()
+
+    os.makedirs(args.out, exist_ok=True)
+    settings = {'input': _file_id(args.input), 'checkpoint': weights, 'shard_size': args.shard_size,
+                'permuted': args.permuted, 'data_seed': args.data_seed}
+    manifest = Manifest(os.path.join(args.out, 'manifest.json'), settings)
+    for name, shape, dtype in (('logits.npy', (N, output_dim), np.float32), ('preds.npy', (N,), np.int64)):
+        path = os.path.join(args.out, name)
+        if not (manifest.done and os.path.exists(path)):
+            open_memmap(path, mode='w+', dtype=dtype, shape=shape).flush()
+
+    shards = [(i, s, min(s + args.shard_size, N)) for i, s in enumerate(range(0, N, args.shard_size))]
+    todo = [s for s in shards if s[0] not in manifest.done]
+    print(f'{N} sequences, {len(shards)} shards, {len(shards) - len(todo)} already done')
+
+    if not todo:
+        return
+
+    def finished(shard):
+        # runs in the pool's result thread as soon as any shard completes
+        manifest.mark(shard)
+        print(f'shard {len(manifest.done)}/{len(shards)} done')
+
+    ctx = torch.multiprocessing.get_context('spawn')
+    start = time.perf_counter()
+    with ctx.Pool(min(args.workers, len(todo)), _init_worker, (args.checkpoint, threads, args.input, args.out, permutation)) as pool:
+        pending = [pool.apply_async(_run_shard, (i, s, e, args.batch_size), callback=finished) for i, s, e in todo]
+        for r in pending:
+            r.get()
+    done = sum(e - s for _, s, e in todo)
+    elapsed = time.perf_counter() - start
+    print(f'{done} sequences in {elapsed:.1f} s ({done / max(elapsed, 1e-9):.1f}/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Batches/s of the tensor-backed MNIST pipeline against the original
+torchvision + ToTensor DataLoader.
+
+    python -m benchmarks.data_loading --batch-size 256 --workers 8
+"""
+
+import argparse
+import os
+import time
+
+import torchvision.transforms as transforms
+from torch.utils.data import DataLoader
+from torchvision.datasets import MNIST
+
+from mnist_data import TensorBatchLoader, load_mnist
+
+
+def batches_per_second(loader, max_batches):
+    start = time.perf_counter()
+    n = 0
+    for n, _ in enumerate(loader, 1):
+        if n == max_batches:
+            break
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--root', default=os.getcwd())
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--max-batches', type=int, default=200)
+    args = parser.parse_args()
+
+    dataset = MNIST(args.root, train=True, download=True, transform=transforms.ToTensor())
+    legacy = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers)
+
+    start = time.perf_counter()
+    images, labels = load_mnist(args.root, train=True)
+    load_time = time.perf_counter() - start
+    tensor = TensorBatchLoader(images, labels, batch_size=args.batch_size, shuffle=True)
+
+    legacy_rate = batches_per_second(legacy, args.max_batches)
+    tensor_rate = batches_per_second(tensor, args.max_batches)
+    print(f'legacy DataLoader ({args.workers} workers): {legacy_rate:10.1f} batches/s')
+    print(f'TensorBatchLoader:                {tensor_rate:10.1f} batches/s  (load {load_time*1e3:.1f} ms)')
+    print(f'speedup: {tensor_rate / legacy_rate:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Early-exit inference against the full scan on the SeqMNIST validation split:
+average steps consumed, throughput and accuracy for a sweep of confidence
+thresholds. Use a checkpoint trained with --exit-loss-interval for reliable
+early readouts; random weights rarely cross any threshold.
+
+    python -m benchmarks.early_exit --checkpoint model.ckpt --thresholds 0.8 0.9 0.99
+"""
+
+import argparse
+import os
+import time
+
+import torch
+
+from rwkv_model import RwkvModel
+from seqMNIST import SeqMNIST
+
+
+@torch.inference_mode()
+def evaluate(fn, loader, max_batches):
+    correct = total = steps = 0
+    elapsed = 0.0
+    for i, (x, y) in enumerate(loader):
+        if i == max_batches:
+            break
+        start = time.perf_counter()
+        logits, used = fn(x)
+        elapsed += time.perf_counter() - start
+        correct += (logits.argmax(1) == y).sum().item()
+        steps += used.sum().item()
+        total += len(y)
+    return correct / total, steps / total, total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--root', default=os.getcwd(), help='MNIST data root')
+    parser.add_argument('--input-scan-dim', type=int, default=28)
+    parser.add_argument('--permuted', action='store_true')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.8, 0.9, 0.95, 0.99])
+    parser.add_argument('--interval', type=int, default=None, help='steps between readouts, default T // 7')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--max-batches', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.checkpoint:
+        model = RwkvModel.from_checkpoint(args.checkpoint)
+    else:
+        model = RwkvModel(args.input_scan_dim, 10)
+    model.eval()
+    module = SeqMNIST(model, 0.0, args.batch_size, args.permuted, data_root=args.root)
+    module.setup('validate')
+    loader = module.val_dataloader()
+    T = module.mnist_dim // model.input_scan_dim
+
+    def full(x):
+        x = module._scan(x)
+        return model(x), torch.full((x.size(0),), T)
+
+    accuracy, steps, base_rate = evaluate(full, loader, args.max_batches)
+    print(f'full scan       accuracy {accuracy:7.2%}  steps {steps:6.1f}/{T}  {base_rate:9.1f} samples/s')
+    for threshold in args.thresholds:
+        def early(x):
+            return model.forward_early_exit(module._scan(x), threshold=threshold, interval=args.interval)
+
+        accuracy, steps, rate = evaluate(early, loader, args.max_batches)
+        print(f'threshold {threshold:5.3f} accuracy {accuracy:7.2%}  steps {steps:6.1f}/{T}  {rate:9.1f} samples/s  '
+              f'speedup {rate / base_rate:5.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Models trained per hour: one vectorized EnsembleModel of N members against N
+separate single-model processes sharing the same cores, on synthetic batches.
+
+    python -m benchmarks.ensemble --members 1 4 8 --steps 20 --steps-per-model 10000
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+
+
+def train_single(seed, batch_size, steps, threads, kwargs):
+    import torch
+    from torch.nn import functional as F
+
+    from rwkv_model import RwkvModel
+
+    torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    model = RwkvModel(28, 10, **kwargs)
+    opt = torch.optim.Adam(model.parameters(), lr=5e-4)
+    x, y = torch.rand(batch_size, 28, 28), torch.randint(0, 10, (batch_size,))
+    start = time.perf_counter()
+    for _ in range(steps):
+        opt.zero_grad()
+        F.cross_entropy(model(x), y).backward()
+        opt.step()
+    return time.perf_counter() - start
+
+
+def train_ensemble(members, batch_size, steps, threads, kwargs):
+    import torch
+    from torch.nn import functional as F
+
+    from ensemble import EnsembleModel, StackedAdam
+
+    torch.set_num_threads(threads)
+    model = EnsembleModel(28, 10, [dict(seed=i) for i in range(members)], **kwargs)
+    opt = StackedAdam(model.parameters(), model.learning_rates(5e-4))
+    x, y = torch.rand(batch_size, 28, 28), torch.randint(0, 10, (batch_size,))
+    start = time.perf_counter()
+    for _ in range(steps):
+        opt.zero_grad()
+        out = model(x)
+        F.cross_entropy(out.flatten(0, 1), y.repeat(members), reduction='sum').div(batch_size).backward()
+        opt.step()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--steps', type=int, default=10, help='timed optimizer steps per run')
+    parser.add_argument('--steps-per-model', type=int, default=5 * 176, help='steps of one full training run (default 5 epochs of 45k)')
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--n-layer', type=int, default=4)
+    parser.add_argument('--n-embd', type=int, default=64)
+    args = parser.parse_args()
+
+    kwargs = dict(n_layer=args.n_layer, n_embd=args.n_embd)
+    ctx = multiprocessing.get_context('spawn')
+    for n in args.members:
+        with ctx.Pool(1) as pool:
+            vectorized = pool.apply(train_ensemble, (n, args.batch_size, args.steps, args.threads, kwargs))
+        # N independent runs split the cores, like N concurrent main.py processes
+        with ctx.Pool(n) as pool:
+            threads = max(1, args.threads // n)
+            separate = max(pool.starmap(train_single, [(i, args.batch_size, args.steps, threads, kwargs) for i in range(n)]))
+
+        def per_hour(seconds):
+            return n * 3600 / (seconds / args.steps * args.steps_per_model)
+
+        print(f'N={n:3d}  vectorized {per_hour(vectorized):8.2f} models/h   separate processes {per_hour(separate):8.2f} models/h   '
+              f'speedup {separate / vectorized:5.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Accuracy, model size and CPU throughput of the quantized inference modes
+against fp32. Calibration and the accuracy check use the SeqMNIST
+validation split; without a checkpoint the weights are random and only the
+agreement with fp32 predictions is meaningful.
+
+    python -m benchmarks.quantization --checkpoint model.ckpt --root ./data
+"""
+
+import argparse
+import os
+import time
+
+import torch
+
+from quantization import MODES, calibrate_seqmnist, model_size_bytes, quantize_model
+from rwkv_model import RwkvModel
+from seqMNIST import SeqMNIST
+
+
+@torch.inference_mode()
+def evaluate(module, loader, max_batches):
+    correct = total = 0
+    preds = []
+    elapsed = 0.0
+    for i, (x, y) in enumerate(loader):
+        if i == max_batches:
+            break
+        start = time.perf_counter()
+        pred = module(x).argmax(1)
+        elapsed += time.perf_counter() - start
+        correct += (pred == y).sum().item()
+        total += len(y)
+        preds.append(pred)
+    return correct / total, total / elapsed, torch.cat(preds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--root', default=os.getcwd(), help='MNIST data root')
+    parser.add_argument('--input-scan-dim', type=int, default=28)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--calibration-batches', type=int, default=16)
+    parser.add_argument('--max-batches', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.checkpoint:
+        model = RwkvModel.from_checkpoint(args.checkpoint)
+    else:
+        model = RwkvModel(args.input_scan_dim, 10)
+    module = SeqMNIST(model, 0.0, args.batch_size, False, data_root=args.root)
+    act_scales = calibrate_seqmnist(module, args.calibration_batches)
+    loader = module.val_dataloader()
+
+    reference = None
+    for mode in MODES:
+        module.model = quantize_model(model, mode, act_scales)
+        accuracy, rate, preds = evaluate(module, loader, args.max_batches)
+        if reference is None:
+            reference = preds
+        agreement = (preds == reference).float().mean().item()
+        print(f'{mode:12s} accuracy {accuracy:7.2%}  agreement {agreement:7.2%}  '
+              f'size {model_size_bytes(module.model) / 2**20:7.3f} MB  {rate:9.1f} samples/s')
+
+
+if __name__ == '__main__':
+    main()
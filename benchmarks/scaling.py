@@ -0,0 +1,70 @@
+"""
+Data-parallel CPU scaling: training samples/s of RwkvModel under
+DistributedDataParallel (gloo, file rendezvous) against the number of
+processes, with the cores split evenly between them. Synthetic batches, the
+per-process batch size stays fixed (weak scaling).
+
+    python -m benchmarks.scaling --processes 1 2 4 8 --batch-size 64
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+
+def worker(rank, world_size, init_file, threads, batch_size, steps, kwargs, results):
+    import torch.distributed as dist
+    from torch.nn import functional as F
+
+    from rwkv_model import RwkvModel
+
+    torch.set_num_threads(threads)
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=world_size)
+    torch.manual_seed(rank)
+    model = torch.nn.parallel.DistributedDataParallel(RwkvModel(28, 10, **kwargs))
+    opt = torch.optim.Adam(model.parameters(), lr=5e-4)
+    x, y = torch.rand(batch_size, 28, 28), torch.randint(0, 10, (batch_size,))
+
+    def step():
+        opt.zero_grad()
+        F.cross_entropy(model(x), y).backward()
+        opt.step()
+
+    step()
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    dist.barrier()
+    results[rank] = time.perf_counter() - start
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--cores', type=int, default=len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=64, help='per process')
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--n-layer', type=int, default=4)
+    parser.add_argument('--n-embd', type=int, default=64)
+    args = parser.parse_args()
+
+    kwargs = dict(n_layer=args.n_layer, n_embd=args.n_embd)
+    base = None
+    for n in args.processes:
+        threads = max(1, args.cores // n)
+        with tempfile.TemporaryDirectory() as tmp:
+            results = mp.Manager().dict()
+            mp.spawn(worker, (n, os.path.join(tmp, 'rdzv'), threads, args.batch_size, args.steps, kwargs, results), nprocs=n)
+        rate = n * args.batch_size * args.steps / max(results.values())
+        base = base or rate / n
+        print(f'{n:3d} processes x {threads:2d} threads  {rate:9.1f} samples/s  efficiency {rate / (base * n):6.1%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Startup cost: imports, model construction, meta-device loading from a
+checkpoint and SeqMNIST construction, each timed in a fresh interpreter.
+
+    python -m benchmarks.startup --n-layer 4 --n-embd 64 --repeats 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SETUP = 'import time, torch\n'
+
+CASES = {
+    'import rwkv_model': (
+        'import time\nt = time.perf_counter()\nimport rwkv_model\n'),
+    'RwkvModel()': (
+        SETUP + 'from rwkv_model import RwkvModel\nt = time.perf_counter()\n'
+        'RwkvModel(28, 10, n_layer={n_layer}, n_embd={n_embd})\n'),
+    'RwkvModel.from_checkpoint()': (
+        SETUP + 'from rwkv_model import RwkvModel\nt = time.perf_counter()\n'
+        'RwkvModel.from_checkpoint({checkpoint!r})\n'),
+    'RwkvModel.from_checkpoint(meta)': (
+        SETUP + 'from rwkv_model import RwkvModel\nt = time.perf_counter()\n'
+        'RwkvModel.from_checkpoint({checkpoint!r}, meta=True)\n'),
+    'SeqMNIST(RwkvModel())': (
+        SETUP + 'from rwkv_model import RwkvModel\nfrom seqMNIST import SeqMNIST\nt = time.perf_counter()\n'
+        'SeqMNIST(RwkvModel(28, 10, n_layer={n_layer}, n_embd={n_embd}), 5e-4, 256, False, data_root="/nonexistent")\n'),
+}
+
+
+def time_case(code, repeats):
+    code += 'print((time.perf_counter() - t) * 1e3)\n'
+    return [float(subprocess.check_output([sys.executable, '-c', code], text=True).split()[-1]) for _ in range(repeats)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-layer', type=int, default=4)
+    parser.add_argument('--n-embd', type=int, default=64)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    import torch
+
+    from rwkv_model import RwkvModel
+
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = os.path.join(tmp, 'model.pt')
+        torch.save(RwkvModel(28, 10, n_layer=args.n_layer, n_embd=args.n_embd).state_dict(), checkpoint)
+        for name, code in CASES.items():
+            ms = time_case(code.format(checkpoint=checkpoint, **vars(args)), args.repeats)
+            print(f'{name:32s} median {statistics.median(ms):8.1f} ms   min {min(ms):8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
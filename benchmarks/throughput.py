@@ -0,0 +1,165 @@
+"""
+Training / inference throughput, latency and memory of RwkvModel on
+synthetic inputs (no dataset needed).
+
+Every point of the sweep runs in a fresh process so peak RSS is per point.
+
+    python -m benchmarks.throughput --n-layer 2 4 --batch-size 32 256 --out bench.json
+    python -m benchmarks.throughput --out new.json --baseline bench.json --tolerance 0.1
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+# sweep dimensions, identify a point across runs
+KEYS = ('n_layer', 'n_embd', 'batch_size', 'scan_dim', 'tmix', 'wkv_mode', 'layer_major')
+
+# (metric, True if higher is better), used by the compare mode
+METRICS = {
+    'forward_samples_per_s': True,
+    'train_samples_per_s': True,
+    'step_latency_ms': False,
+    'construct_ms': False,
+    'peak_rss_mb': False,
+    'activation_mb': False,
+}
+
+
+def import_time_ms():
+    code = 'import time; t = time.perf_counter(); import rwkv_model; print((time.perf_counter() - t) * 1e3)'
+    return float(subprocess.check_output([sys.executable, '-c', code], text=True))
+
+
+def _timed(fn, warmup, repeats):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def run_point(point, warmup, repeats):
+    import torch
+
+    from rwkv_model import RwkvModel
+
+    torch.manual_seed(0)
+    T = 784 // point['scan_dim']
+    start = time.perf_counter()
+    model = RwkvModel(point['scan_dim'], 10, n_layer=point['n_layer'], n_embd=point['n_embd'], tmix=point['tmix'],
+                      layer_major=bool(point['layer_major']), wkv_mode=point['wkv_mode'])
+    construct = time.perf_counter() - start
+
+    B = point['batch_size']
+    x = torch.rand(B, T, point['scan_dim'])
+    y = torch.randint(0, 10, (B,))
+
+    def forward():
+        with torch.inference_mode():
+            model(x)
+
+    def train():
+        model.zero_grad(set_to_none=True)
+        torch.nn.functional.cross_entropy(model(x), y).backward()
+
+    saved = [0]
+
+    def pack(t):
+        saved[0] += t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        model(x)
+
+    fwd = _timed(forward, warmup, repeats)
+    trn = _timed(train, warmup, repeats)
+    result = dict(point)
+    result.update(
+        seq_len=T,
+        construct_ms=construct * 1e3,
+        forward_samples_per_s=B / fwd,
+        train_samples_per_s=B / trn,
+        step_latency_ms=fwd / T * 1e3,
+        activation_mb=saved[0] / 2**20,
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+    )
+    if torch.cuda.is_available():
+        result['cuda_max_allocated_mb'] = torch.cuda.max_memory_allocated() / 2**20
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of human readable regressions against a saved baseline"""
+    def key(r):
+        return tuple(r.get(k) for k in KEYS)
+
+    base = {key(r): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        b = base.get(key(r))
+        if b is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            old, new = b[metric], r[metric]
+            change = (new - old) / old if old else 0.0
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(f'{key(r)} {metric}: {old:.4g} -> {new:.4g} ({change:+.1%})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-layer', type=int, nargs='+', default=[4])
+    parser.add_argument('--n-embd', type=int, nargs='+', default=[64])
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[64])
+    parser.add_argument('--scan-dim', type=int, nargs='+', default=[28], help='input_scan_dim, sequence length is 784 / scan_dim')
+    parser.add_argument('--tmix', nargs='+', default=['x060c'], choices=['x060c', 'x060'])
+    parser.add_argument('--wkv-mode', nargs='+', default=['chunked'], choices=['recurrent', 'chunked', 'checkpoint'])
+    parser.add_argument('--layer-major', type=int, nargs='+', default=[1], choices=[0, 1], help='0 runs the timestep loop')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--out', default=None, help='write results as JSON')
+    parser.add_argument('--baseline', default=None, help='JSON from a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change counted as a regression')
+    args = parser.parse_args()
+
+    grid = itertools.product(args.n_layer, args.n_embd, args.batch_size, args.scan_dim, args.tmix, args.wkv_mode, args.layer_major)
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    for values in grid:
+        point = dict(zip(KEYS, values))
+        with ctx.Pool(1) as pool:
+            r = pool.apply(run_point, (point, args.warmup, args.repeats))
+        results.append(r)
+        print(f"{point}  fwd {r['forward_samples_per_s']:9.1f}/s  train {r['train_samples_per_s']:9.1f}/s  "
+              f"step {r['step_latency_ms']:7.3f} ms  rss {r['peak_rss_mb']:7.1f} MB  act {r['activation_mb']:7.1f} MB")
+
+    report = {
+        'import_ms': import_time_ms(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION', line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
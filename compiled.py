@@ -0,0 +1,258 @@
+"""
+Compiled and exported graphs of RwkvModel.
+
+Two entry points with a plain-tensor boundary (the state is the legacy
+packed (B, n_layer * (2 + S), n_embd) tensor):
+
+    step      (x_t (B, input_scan_dim), state) -> (logits, state)
+    sequence  (B, T, input_scan_dim)           -> logits, from the zero state
+
+CompiledRwkv runs them through torch.compile. Batch sizes are padded up to a
+power of two so a serving process compiles each bucket once instead of once
+per batch size, and any compile or runtime failure of the compiled graph
+permanently falls back to eager.
+
+export_artifact writes TorchScript or torch.export files that load without
+the Python model classes, cached on disk under a key made of the model
+config, the weights hash and the torch version.
+"""
+
+import hashlib
+import json
+import os
+import warnings
+
+import torch
+from torch import nn
+
+from rwkv_state import RwkvState
+
+
+def state_rows(args):
+    return args.n_layer * (2 + args.head_size_a)
+
+
+def zero_state(model, batch_size, device=None, dtype=torch.float32):
+    return torch.zeros(batch_size, state_rows(model.gpt_config), model.gpt_config.n_embd, device=device, dtype=dtype)
+
+
+class StepGraph(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.encoder
+        self.rwkv = model.rwkv
+        self.readout = model.readout
+
+    def forward(self, x, state):
+        out, state = self.rwkv(self.encoder(x), state)
+        return self.readout(out), state
+
+
+class SequenceGraph(nn.Module):
+    """Layer-major pass over the whole sequence, without the data-dependent blank-prefix grouping"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.args = model.gpt_config
+        self.encoder = model.encoder
+        self.rwkv = model.rwkv
+        self.readout = model.readout
+
+    def forward(self, x):
+        state = RwkvState.zeros(self.args, x.size(0), device=x.device, dtype=x.dtype)
+        out, _ = self.rwkv(self.encoder(x), state)
+        return self.readout(out[:, -1])
+
+
+def bucket(n, min_bucket=1):
+    return max(min_bucket, 1 << (n - 1).bit_length())
+
+
+def _pad_batch(x, size):
+    if x.size(0) == size:
+        return x
+    return torch.cat((x, x.new_zeros(size - x.size(0), *x.shape[1:])))
+
+
+class CompiledRwkv:
+    """
+    torch.compile'd step and sequence functions of an eval-mode RwkvModel.
+
+        runner = CompiledRwkv(model)
+        logits = runner(images)                       # (B, 1, 28, 28) or (B, T, scan)
+        logits, state = runner.step(rows, state)      # state from runner.zero_state(B)
+    """
+
+    def __init__(self, model, backend='inductor', mode=None, min_bucket=8, fallback=True):
+        self.model = model.eval()
+        self.min_bucket = min_bucket
+        self.fallback = fallback
+        self._eager = {'step': StepGraph(model), 'sequence': SequenceGraph(model)}
+        self._compiled = {k: torch.compile(m, backend=backend, mode=mode, dynamic=False) for k, m in self._eager.items()}
+        # one graph per bucket, powers of two up to 2**16
+        limit = 'recompile_limit' if hasattr(torch._dynamo.config, 'recompile_limit') else 'cache_size_limit'
+        setattr(torch._dynamo.config, limit, max(getattr(torch._dynamo.config, limit), 17))
+
+    def _run(self, kind, *args):
+        fn = self._compiled.get(kind)
+        if fn is not None:
+            # the chunked kernel picks its form from the data (wkv.py), which breaks
+            # the graph; traced calls always take the exact per-chunk form instead
+            config = self.model.gpt_config
+            safe = getattr(config, 'wkv_chunk_safe', None)
+            config.wkv_chunk_safe = True if safe is None else safe
+            try:
+                return fn(*args)
+            except Exception as e:
+                if not self.fallback:
+                    raise
+                warnings.warn(f'compiled {kind} graph failed, running eager from now on: {e!r}')
+                self._compiled.pop(kind)
+            finally:
+                config.wkv_chunk_safe = safe
+        return self._eager[kind](*args)
+
+    def zero_state(self, batch_size, device=None):
+        return zero_state(self.model, batch_size, device=device)
+
+    @torch.inference_mode()
+    def step(self, x, state):
+        B = x.size(0)
+        size = bucket(B, self.min_bucket)
+        logits, state = self._run('step', _pad_batch(x, size), _pad_batch(state, size))
+        return logits[:B], state[:B]
+
+    @torch.inference_mode()
+    def __call__(self, x):
+        x = x.reshape(x.size(0), -1, self.model.input_scan_dim)
+        B = x.size(0)
+        return self._run('sequence', _pad_batch(x, bucket(B, self.min_bucket)))[:B]
+
+
+class _StepLoop(nn.Module):
+    """Scriptable whole-sequence loop around a traced step"""
+
+    def __init__(self, step, rows, n_embd):
+        super().__init__()
+        self.step = step
+        self.rows = rows
+        self.n_embd = n_embd
+
+    def forward(self, x):
+        state = torch.zeros(x.size(0), self.rows, self.n_embd, dtype=x.dtype, device=x.device)
+        logits = torch.empty(0)
+        for t in range(x.size(1)):
+            logits, state = self.step(x[:, t], state)
+        return logits
+
+
+def artifact_key(model, kind, fmt, seq_len=None):
+    key = {
+        'config': model.config(),
+        'weights': model.weights_hash(),
+        'kind': kind,
+        'format': fmt,
+        'seq_len': seq_len,
+        'torch': torch.__version__,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:24]
+
+
+def _build(model, kind, fmt, seq_len, batch_size):
+    args = model.gpt_config
+    x_t = torch.rand(batch_size, model.input_scan_dim)
+    state = zero_state(model, batch_size)
+    if fmt == 'torchscript':
+        step = torch.jit.trace(StepGraph(model), (x_t, state), check_trace=False)
+        if kind == 'step':
+            return step
+        # the loop is scripted, so the artifact runs any sequence length
+        return torch.jit.script(_StepLoop(step, state_rows(args), args.n_embd))
+
+    batch = torch.export.Dim('batch', min=2)
+    if kind == 'step':
+        return torch.export.export(StepGraph(model), (x_t, state), dynamic_shapes=({0: batch}, {0: batch}))
+    # the data-dependent fallback of the chunked kernel can't be exported,
+    # the exported sequence graph unrolls the recurrent kernel over seq_len
+    wkv_mode = args.wkv_mode
+    args.wkv_mode = 'recurrent'
+    try:
+        x = torch.rand(batch_size, seq_len, model.input_scan_dim)
+        return torch.export.export(SequenceGraph(model), (x,), dynamic_shapes=({0: batch},))
+    finally:
+        args.wkv_mode = wkv_mode
+
+
+def load_artifact(path):
+    if path.endswith('.pt2'):
+        return torch.export.load(path).module()
+    return torch.jit.load(path)
+
+
+@torch.no_grad()
+def export_artifact(model, kind='step', fmt='torchscript', cache_dir='compiled_cache', seq_len=None):
+    """
+    Loads, or builds and saves, a standalone step / sequence graph of model.
+
+    fmt is 'torchscript' (.pt, any sequence length) or 'export' (.pt2,
+    torch.export; the sequence graph is specialized to seq_len, which defaults
+    to 784 // input_scan_dim). Returns (callable, path).
+    """
+    if kind not in ('step', 'sequence') or fmt not in ('torchscript', 'export'):
+        raise ValueError(f'unsupported artifact {kind!r} / {fmt!r}')
+    model = model.eval()
+    if fmt == 'export' and kind == 'sequence':
+        seq_len = seq_len or 784 // model.input_scan_dim
+    else:
+        seq_len = None
+    ext = '.pt2' if fmt == 'export' else '.pt'
+    path = os.path.join(cache_dir, f'{kind}-{artifact_key(model, kind, fmt, seq_len)}{ext}')
+    if not os.path.exists(path):
+        artifact = _build(model, kind, fmt, seq_len, batch_size=4)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = os.path.join(cache_dir, f'.{os.getpid()}-{os.path.basename(path)}')
+        if fmt == 'export':
+            torch.export.save(artifact, tmp)
+        else:
+            artifact.save(tmp)
+        os.replace(tmp, path)
+    return load_artifact(path), path
+
+
+if __name__ == '__main__':
+    import tempfile
+    import time
+
+    from rwkv_model import RwkvModel
+
+    torch.manual_seed(0)
+    model = RwkvModel(28, 10).eval()
+    x = torch.rand(13, 28, 28)
+    with torch.inference_mode():
+        ref = model(x)
+        rows = x[:, 0]
+        ref_step, ref_state = StepGraph(model)(rows, zero_state(model, 13))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt in ('torchscript', 'export'):
+            for kind in ('step', 'sequence'):
+                start = time.perf_counter()
+                fn, path = export_artifact(model, kind, fmt, cache_dir=tmp)
+                built = time.perf_counter() - start
+                start = time.perf_counter()
+                export_artifact(model, kind, fmt, cache_dir=tmp)
+                cached = time.perf_counter() - start
+                with torch.inference_mode():
+                    if kind == 'step':
+                        out, state = fn(rows, zero_state(model, 13))
+                        diff = max((out - ref_step).abs().max().item(), (state - ref_state).abs().max().item())
+                    else:
+                        diff = (fn(x) - ref).abs().max().item()
+                print(f'{fmt:12s} {kind:9s} build {built:6.2f} s  cached load {cached:6.2f} s  max abs diff {diff:.2e}')
+
+    runner = CompiledRwkv(model)
+    for B in (13, 16, 5):
+        start = time.perf_counter()
+        diff = (runner(x[:B]) - ref[:B]).abs().max().item()
+        print(f'compiled sequence B={B:3d} {time.perf_counter() - start:6.2f} s  max abs diff {diff:.2e}')
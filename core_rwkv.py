@@ -13,14 +13,16 @@ training using the rnn mode
 """
 
 
-import gc
-import math
 import types
 
 import torch
 from torch import nn
 from torch.nn import functional as F
 
+from profiling import hotpath
+from rwkv_state import RwkvState
+from wkv import run_wkv
+
 
 class RWKV_Tmix_x060(nn.Module):
     def __init__(self, args, layer_id):
@@ -33,11 +35,10 @@ class RWKV_Tmix_x060(nn.Module):
         assert args.dim_att % self.n_head == 0
 
         with torch.no_grad():
-            ratio_0_to_1 = layer_id / (args.n_layer - 1)  # 0 to 1
+            ratio_0_to_1 = layer_id / max(args.n_layer - 1, 1)  # 0 to 1
             ratio_1_to_almost0 = 1.0 - (layer_id / args.n_layer)  # 1 to ~0
-            ddd = torch.ones(1, 1, args.n_embd)
-            for i in range(args.n_embd):
-                ddd[0, 0, i] = i / args.n_embd
+            # computed in float64 then rounded, bit-identical to filling i / n_embd one by one
+            ddd = (torch.arange(args.n_embd, dtype=torch.float64) / args.n_embd).float().view(1, 1, -1)
 
             # fancy time_mix
             self.time_maa_x = nn.Parameter(1.0 - torch.pow(ddd, ratio_1_to_almost0))
@@ -52,19 +53,16 @@ class RWKV_Tmix_x060(nn.Module):
             self.time_maa_w2 = nn.Parameter(torch.zeros(5, D_MIX_LORA, args.n_embd).uniform_(-0.01, 0.01))
 
             # fancy time_decay
-            decay_speed = torch.ones(args.dim_att)
-            for n in range(args.dim_att):
-                decay_speed[n] = -6 + 5 * (n / (args.dim_att - 1)) ** (0.7 + 1.3 * ratio_0_to_1)
+            n = torch.arange(args.dim_att, dtype=torch.float64)
+            decay_speed = (-6 + 5 * (n / (args.dim_att - 1)) ** (0.7 + 1.3 * ratio_0_to_1)).float()
             self.time_decay = nn.Parameter(decay_speed.reshape(1, 1, args.dim_att))
 
             D_DECAY_LORA = 64
             self.time_decay_w1 = nn.Parameter(torch.zeros(args.n_embd, D_DECAY_LORA))
             self.time_decay_w2 = nn.Parameter(torch.zeros(D_DECAY_LORA, args.dim_att).uniform_(-0.01, 0.01))
 
-            tmp = torch.zeros(args.dim_att)
-            for n in range(args.dim_att):
-                zigzag = ((n + 1) % 3 - 1) * 0.1
-                tmp[n] = ratio_0_to_1 * (1 - (n / (args.dim_att - 1))) + zigzag
+            zigzag = ((n + 1) % 3 - 1) * 0.1
+            tmp = (ratio_0_to_1 * (1 - (n / (args.dim_att - 1))) + zigzag).float()
             # original code has an unsqeeze when unpacking weights, I just apply it here
             self.time_faaaa = nn.Parameter(tmp.reshape(self.n_head, self.head_size, 1))
 
@@ -77,16 +75,13 @@ class RWKV_Tmix_x060(nn.Module):
         self.ln_x = nn.GroupNorm(self.n_head, args.dim_att, eps=(1e-5)*(args.head_size_divisor**2))
 
     def forward(self, x, state):
-        new_state = state.clone()
         B = x.shape[0]
         H = self.n_head
         S = self.head_size
         i = self.layer_id
-        i1 = (2+S)*self.layer_id+1
-        sx = state[:, i1, :] - x
-        new_state[:, i1, :] = x
+        sx = state.att_x[i] - x
         xxx = x + sx * self.time_maa_x
-        xxx = torch.tanh(xxx @ self.time_maa_w1).view(5, B, -1)
+        xxx = torch.tanh(xxx @ self.time_maa_w1).view(B, 5, -1).transpose(0, 1)
         xxx = torch.bmm(xxx, self.time_maa_w2).view(5, B, -1)
         mw, mk, mv, mr, mg = xxx.unbind(dim=0)
 
@@ -104,16 +99,48 @@ class RWKV_Tmix_x060(nn.Module):
         v = self.value(xv).view(B, H, 1, S) #
         g = F.silu(self.gate(xg))
 
-        s = state[:, (2+S)*i+2:(2+S)*(i+1), :].reshape(B, H, S, S)
+        s = state.wkv[i]
 
         a = k @ v
-        x = r @ (self.time_faaaa * a + s)
+        out = r @ (self.time_faaaa * a + s)
         s = a + w * s
 
-        new_state[:, (2+S)*i+2:(2+S)*(i+1), :] = s.reshape(B, S, -1)
-        x = x.flatten(1)
+        state = state.update_att(i, x, s)
+        x = out.flatten(1)
         x = self.ln_x(x) * g.squeeze(0)
-        return self.output(x), new_state
+        return self.output(x), state
+
+    def forward_seq(self, x, state):
+        B, T, C = x.shape
+        H = self.n_head
+        S = self.head_size
+        i = self.layer_id
+        sx = torch.cat((state.att_x[i].unsqueeze(1), x[:, :-1]), dim=1) - x
+        xxx = x + sx * self.time_maa_x
+        xxx = torch.tanh(xxx @ self.time_maa_w1).view(B*T, 5, -1).transpose(0, 1)
+        xxx = torch.bmm(xxx, self.time_maa_w2).view(5, B, T, -1)
+        mw, mk, mv, mr, mg = xxx.unbind(dim=0)
+
+        xw = x + sx * (self.time_maa_w + mw)
+        xk = x + sx * (self.time_maa_k + mk)
+        xv = x + sx * (self.time_maa_v + mv)
+        xr = x + sx * (self.time_maa_r + mr)
+        xg = x + sx * (self.time_maa_g + mg)
+
+        w = self.time_decay + (torch.tanh(xw @ self.time_decay_w1) @ self.time_decay_w2).float()
+        w = torch.exp(-torch.exp(w.float()))
+
+        r = self.receptance(xr)
+        k = self.key(xk)
+        v = self.value(xv)
+        g = F.silu(self.gate(xg))
+
+        s = state.wkv[i]
+        out, s = run_wkv(self.args, r.view(B, T, H, S), k.view(B, T, H, S), v.view(B, T, H, S), w.view(B, T, H, S), self.time_faaaa, s)
+
+        state = state.update_att(i, x[:, -1], s)
+        x = self.ln_x(out.reshape(B*T, -1)).view(B, T, -1) * g
+        return self.output(x), state
 
 
 class RWKV_Tmix_x060c(nn.Module):
@@ -129,9 +156,8 @@ class RWKV_Tmix_x060c(nn.Module):
         with torch.no_grad():
             ratio_0_to_1 = layer_id / max(args.n_layer - 1, 1)  # 0 to 1
             ratio_1_to_almost0 = 1.0 - (layer_id / args.n_layer)  # 1 to ~0
-            ddd = torch.ones(1, 1, args.n_embd)
-            for i in range(args.n_embd):
-                ddd[0, 0, i] = i / args.n_embd
+            # computed in float64 then rounded, bit-identical to filling i / n_embd one by one
+            ddd = (torch.arange(args.n_embd, dtype=torch.float64) / args.n_embd).float().view(1, 1, -1)
 
             # fancy time_mix
             self.time_maa_x = nn.Parameter(1.0 - torch.pow(ddd, ratio_1_to_almost0))
@@ -146,19 +172,16 @@ class RWKV_Tmix_x060c(nn.Module):
             self.time_maa_w2 = nn.Parameter(torch.zeros(4, D_MIX_LORA, args.n_embd).uniform_(-0.01, 0.01))
 
             # fancy time_decay
-            decay_speed = torch.ones(args.dim_att)
-            for n in range(args.dim_att):
-                decay_speed[n] = -6 + 5 * (n / (args.dim_att - 1)) ** (0.7 + 1.3 * ratio_0_to_1)
+            n = torch.arange(args.dim_att, dtype=torch.float64)
+            decay_speed = (-6 + 5 * (n / (args.dim_att - 1)) ** (0.7 + 1.3 * ratio_0_to_1)).float()
             self.time_decay = nn.Parameter(decay_speed.reshape(1, 1, args.dim_att))
 
             D_DECAY_LORA = 64
             self.time_decay_w1 = nn.Parameter(torch.zeros(args.n_embd, D_DECAY_LORA))
             self.time_decay_w2 = nn.Parameter(torch.zeros(D_DECAY_LORA, args.dim_att).uniform_(-0.01, 0.01))
 
-            tmp = torch.zeros(args.dim_att)
-            for n in range(args.dim_att):
-                zigzag = ((n + 1) % 3 - 1) * 0.1
-                tmp[n] = ratio_0_to_1 * (1 - (n / (args.dim_att - 1))) + zigzag
+            zigzag = ((n + 1) % 3 - 1) * 0.1
+            tmp = (ratio_0_to_1 * (1 - (n / (args.dim_att - 1))) + zigzag).float()
             # original code has an unsqeeze when unpacking weights, I just apply it here
             self.time_faaaa = nn.Parameter(tmp.reshape(self.n_head, self.head_size, 1))
 
@@ -171,35 +194,32 @@ class RWKV_Tmix_x060c(nn.Module):
         self.ln_x = nn.LayerNorm(args.dim_att)
 
     def forward(self, x, state):
-        new_state = state.clone()
         B = x.shape[0]
         H = self.n_head
         S = self.head_size
         i = self.layer_id
-        i1 = (2+S)*self.layer_id+1
-        sx = state[:, i1, :] - x
-        new_state[:, i1, :] = x
-        xxx = x + sx * self.time_maa_x
-        xxx = torch.tanh(xxx @ self.time_maa_w1).view(B, 4, -1).transpose(0, 1)
-        xxx = torch.bmm(xxx, self.time_maa_w2).view(4, B, -1)
-        
-        mr, mk, mv, mw = xxx.unbind(dim=0)
-        xr = x + sx * (self.time_maa_r + mr)
-        xk = x + sx * (self.time_maa_k + mk)
-        xv = x + sx * (self.time_maa_v + mv)
-        xw = x + sx * (self.time_maa_w + mw)
-        
+        with hotpath.region('tmix.lora_mix'):
+            sx = state.att_x[i] - x
+            xxx = x + sx * self.time_maa_x
+            xxx = torch.tanh(xxx @ self.time_maa_w1).view(B, 4, -1).transpose(0, 1)
+            xxx = torch.bmm(xxx, self.time_maa_w2).view(4, B, -1)
 
-        r = self.receptance(xr)
-        k = self.key(xk)
-        v = self.value(xv)
-        w = self.time_decay + (torch.tanh(xw @ self.time_decay_w1) @ self.time_decay_w2)
-        w = torch.exp(-torch.exp(w.float()))
+            mr, mk, mv, mw = xxx.unbind(dim=0)
+            xr = x + sx * (self.time_maa_r + mr)
+            xk = x + sx * (self.time_maa_k + mk)
+            xv = x + sx * (self.time_maa_v + mv)
+            xw = x + sx * (self.time_maa_w + mw)
 
+        with hotpath.region('tmix.projections'):
+            r = self.receptance(xr)
+            k = self.key(xk)
+            v = self.value(xv)
+            w = self.time_decay + (torch.tanh(xw @ self.time_decay_w1) @ self.time_decay_w2)
+            w = torch.exp(-torch.exp(w.float()))
 
-        k = k * (1-(-w.exp()).exp())
+            k = k * (1-(-w.exp()).exp())
 
-        s = state[:, (2+S)*i+2:(2+S)*(i+1), :].reshape(B, H, S, S)
+        s = state.wkv[i]
 
         r = r.view(B, H, 1, S)
         k = k.view(B, H, S, 1)
@@ -207,15 +227,57 @@ class RWKV_Tmix_x060c(nn.Module):
         w = w.view(B, H, S, 1)
 
         # core rwkv kernel
-        a = k @ v
-        x = r @ (self.time_faaaa * a + s)
-        s = a + w * s
+        with hotpath.region('tmix.wkv'):
+            a = k @ v
+            out = r @ (self.time_faaaa * a + s)
+            s = a + w * s
 
         # after core
-        new_state[:, (2+S)*i+2:(2+S)*(i+1), :] = s.reshape(B, S, -1)
-        x = x.flatten(1)
-        x = self.ln_x(x)
-        return self.output(x), new_state
+        with hotpath.region('state.update'):
+            state = state.update_att(i, x, s)
+        with hotpath.region('norm.ln_x'):
+            x = self.ln_x(out.flatten(1))
+        with hotpath.region('tmix.output'):
+            return self.output(x), state
+
+    def forward_seq(self, x, state):
+        B, T, C = x.shape
+        H = self.n_head
+        S = self.head_size
+        i = self.layer_id
+        with hotpath.region('tmix.lora_mix'):
+            sx = torch.cat((state.att_x[i].unsqueeze(1), x[:, :-1]), dim=1) - x
+            xxx = x + sx * self.time_maa_x
+            xxx = torch.tanh(xxx @ self.time_maa_w1).view(B*T, 4, -1).transpose(0, 1)
+            xxx = torch.bmm(xxx, self.time_maa_w2).view(4, B, T, -1)
+
+            mr, mk, mv, mw = xxx.unbind(dim=0)
+            xr = x + sx * (self.time_maa_r + mr)
+            xk = x + sx * (self.time_maa_k + mk)
+            xv = x + sx * (self.time_maa_v + mv)
+            xw = x + sx * (self.time_maa_w + mw)
+
+        with hotpath.region('tmix.projections'):
+            r = self.receptance(xr)
+            k = self.key(xk)
+            v = self.value(xv)
+            w = self.time_decay + (torch.tanh(xw @ self.time_decay_w1) @ self.time_decay_w2)
+            w = torch.exp(-torch.exp(w.float()))
+
+            k = k * (1-(-w.exp()).exp())
+
+        s = state.wkv[i]
+
+        # core rwkv kernel, only the S x S recurrence is sequential
+        with hotpath.region('tmix.wkv'):
+            out, s = run_wkv(self.args, r.view(B, T, H, S), k.view(B, T, H, S), v.view(B, T, H, S), w.view(B, T, H, S), self.time_faaaa, s)
+
+        with hotpath.region('state.update'):
+            state = state.update_att(i, x[:, -1], s)
+        with hotpath.region('norm.ln_x'):
+            x = self.ln_x(out.reshape(B, T, -1))
+        with hotpath.region('tmix.output'):
+            return self.output(x), state
 
 class RWKV_CMix_x060(nn.Module):
     def __init__(self, args, layer_id):
@@ -227,9 +289,7 @@ class RWKV_CMix_x060(nn.Module):
 
         with torch.no_grad():  # fancy init of time_mix
             ratio_1_to_almost0 = 1.0 - (layer_id / args.n_layer)  # 1 to ~0
-            ddd = torch.ones(1, args.n_embd)
-            for i in range(args.n_embd):
-                ddd[0, i] = i / args.n_embd
+            ddd = (torch.arange(args.n_embd, dtype=torch.float64) / args.n_embd).float().view(1, -1)
             self.time_maa_k = nn.Parameter(1.0 - torch.pow(ddd, ratio_1_to_almost0))
             self.time_maa_r = nn.Parameter(1.0 - torch.pow(ddd, ratio_1_to_almost0))
 
@@ -238,15 +298,24 @@ class RWKV_CMix_x060(nn.Module):
         self.value = nn.Linear(args.dim_ffn, args.n_embd, bias=False)
 
     def forward(self, x, state):
-        new_state = state.clone()
-        i0 = (2+self.head_size)*self.layer_id+0
-        sx = state[:, i0] - x
+        sx = state.ffn_x[self.layer_id] - x
         xk = x + sx * self.time_maa_k
         xr = x + sx * self.time_maa_r
-        new_state[:, i0] = x
+        with hotpath.region('state.update'):
+            state = state.update_ffn(self.layer_id, x)
         r = torch.sigmoid(self.receptance(xr))
         k = torch.square(torch.relu(self.key(xk))) # square relu, primer paper
-        return r * (self.value(k)), new_state
+        return r * (self.value(k)), state
+
+    def forward_seq(self, x, state):
+        sx = torch.cat((state.ffn_x[self.layer_id].unsqueeze(1), x[:, :-1]), dim=1) - x
+        xk = x + sx * self.time_maa_k
+        xr = x + sx * self.time_maa_r
+        with hotpath.region('state.update'):
+            state = state.update_ffn(self.layer_id, x[:, -1])
+        r = torch.sigmoid(self.receptance(xr))
+        k = torch.square(torch.relu(self.key(xk)))
+        return r * (self.value(k)), state
 
 class Block(nn.Module):
 
@@ -261,17 +330,47 @@ class Block(nn.Module):
         if self.layer_id == 0:
             self.ln0 = nn.LayerNorm(args.n_embd)
 
-        self.att = RWKV_Tmix_x060c(args, layer_id)
+        if getattr(args, 'tmix', 'x060c') == 'x060':
+            self.att = RWKV_Tmix_x060(args, layer_id)
+        else:
+            self.att = RWKV_Tmix_x060c(args, layer_id)
         self.ffn = RWKV_CMix_x060(args, layer_id)
 
     def forward(self, x, state):
 
         if self.layer_id == 0:
-            x = self.ln0(x)
+            with hotpath.region('norm.ln'):
+                x = self.ln0(x)
 
-        tmp_out, state = self.att.forward(self.ln1(x), state)
+        with hotpath.region('norm.ln'):
+            xa = self.ln1(x)
+        with hotpath.region('tmix'):
+            tmp_out, state = self.att.forward(xa, state)
         x = x + tmp_out
-        tmp_out, state = self.ffn.forward(self.ln2(x), state)
+        with hotpath.region('norm.ln'):
+            xf = self.ln2(x)
+        with hotpath.region('cmix'):
+            tmp_out, state = self.ffn.forward(xf, state)
+        x = x + tmp_out
+
+        return x, state
+
+    def forward_seq(self, x, state):
+        # x is (B, T, C): every projection runs over all B*T rows at once
+
+        if self.layer_id == 0:
+            with hotpath.region('norm.ln'):
+                x = self.ln0(x)
+
+        with hotpath.region('norm.ln'):
+            xa = self.ln1(x)
+        with hotpath.region('tmix'):
+            tmp_out, state = self.att.forward_seq(xa, state)
+        x = x + tmp_out
+        with hotpath.region('norm.ln'):
+            xf = self.ln2(x)
+        with hotpath.region('cmix'):
+            tmp_out, state = self.ffn.forward_seq(xf, state)
         x = x + tmp_out
 
         return x, state
@@ -296,70 +395,39 @@ class RWKV(nn.Module):
         # print(f"number of parameters: {self.get_num_params() / 1e6:.2f}M")
 
     def init_params(self):
-        m = self.state_dict()
-        n_params = 0
-
-        for n in self.state_dict():
-            p = m[n]
-            shape = p.shape
-
-            s0 = str(shape[0]) if len(shape) > 0 else ""
-            s1 = str(shape[1]) if len(shape) > 1 else ""
-            s2 = str(shape[2]) if len(shape) > 2 else ""
-            # print(f"{s0.ljust(5)} {s1.ljust(5)} {s2.ljust(5)} {n}", end="")
-
-            scale = 1.0
+        # The reference init assigned fresh tensors into the dict returned by
+        # state_dict() and never loaded them back, so the modules keep their own
+        # initialization. Its one lasting effect is advancing the global RNG
+        # through the orthogonal_ draws: replay exactly those draws, minus the
+        # QR factorizations, so seeded runs stay bit-identical.
+        for n, p in self.state_dict().items():
             if "ln_" in n or ".ln" in n or "time_" in n or n.endswith(("_w", "_w1", "_w2", "_bias")):
-                if "ln_x.weight" in n:
-                    layer_scale = (1+int(n.split(".")[1])) / self.args.n_layer
-                    m[n] = (p * 0.0) + (layer_scale ** 0.7)
-                else:
-                    m[n] = p
-                # print()
-            elif n == "emb.weight":
-                m[n] = p
-                scale = -1e-4
-                nn.init.uniform_(m[n], a=scale, b=-scale) # !!! If you are using positional embedding, maybe it's better to remove block.0.ln0, and use default initialization for emb.weight instead of my uniform_(a=-1e-4, b=1e-4) !!!
-                # print(f" [scale {scale}]")
-            elif n == "head.weight":
-                m[n] = p
-                scale = 0.5 * math.sqrt(self.args.vocab_size / self.args.n_embd) if self.args.vocab_size > self.args.n_embd else 0.5
-                nn.init.orthogonal_(m[n], gain=scale)
-                # print(f" [scale {scale}]")
-            else:
-                assert n.endswith(".weight") # should always be true
-
-                for kk in [".att.output.", ".ffn.value.", ".ffn.receptance."]:
-                    if kk in n:
-                        scale = 0
-                for kk in [".att.key."]:
-                    if kk in n:
-                        scale = 0.1
-                for kk in [".att.gate."]:
-                    if kk in n:
-                        scale = 0.1
-
-                # print(f" [scale {scale}]")
-
-                m[n] = torch.empty((shape[0], shape[1]), device=p.device)
-                if scale == 0:
-                    nn.init.zeros_(m[n])
-                else:
-                    nn.init.orthogonal_(m[n], gain=scale)
-
-            n_params += m[n].numel()
-
-        # print("model params", n_params)
-        gc.collect()
-        torch.cuda.empty_cache()
+                continue
+            if any(kk in n for kk in [".att.output.", ".ffn.value.", ".ffn.receptance."]):
+                continue # zero init, draws nothing
+            if not p.is_meta and p.numel() > 0:
+                torch.empty((p.shape[0], p.shape[1]), device=p.device).normal_(0, 1)
 
     def forward(self, x, state):
-
-        for block in self.blocks:
-            x, state = block(x, state)
+        # x is either a single step (B, C) or a whole sequence (B, T, C),
+        # the latter runs layer-major: each block consumes all T steps in turn.
+        # state is an RwkvState, or the legacy packed tensor which is converted
+        # on the way in and out
+        packed = isinstance(state, torch.Tensor)
+        if packed:
+            state = RwkvState.from_packed(state, self.args)
+
+        if x.dim() == 3:
+            for block in self.blocks:
+                x, state = block.forward_seq(x, state)
+        else:
+            for block in self.blocks:
+                x, state = block(x, state)
 
         x = self.ln_out(x)
 
+        if packed:
+            state = state.to_packed()
         return x, state
 
     def get_num_params(self):
@@ -0,0 +1,168 @@
+"""
+Vectorized ensembles of RwkvModels.
+
+EnsembleModel stacks the parameters of N same-architecture members along a
+leading dim and runs them with torch.func.vmap, so one batch from the data
+pipeline feeds every member in a single set of (wider) kernels. Members can
+differ in seed (initialization) and learning rate; StackedAdam gives every
+member its own learning rate and EnsembleSeqMNIST logs them separately.
+
+    members = [dict(seed=s, learning_rate=lr) for s in range(4) for lr in (5e-4, 1e-3)]
+    module = EnsembleSeqMNIST(EnsembleModel(28, 10, members), 256, False)
+    Trainer(max_epochs=5).fit(module)
+
+vmap can't follow data-dependent Python control flow, so members skip no
+blank prefixes and run the chunked WKV kernel without its overflow check,
+in chunks of 8 steps. Per-step decays are clamped to at least e^-7.5
+instead, which keeps the chunk finite; pass wkv_mode='recurrent' for the
+exact recurrence.
+"""
+
+import copy
+
+import torch
+from torch import nn
+from torch.func import functional_call, stack_module_state, vmap
+from torch.nn import functional as F
+
+from rwkv_model import RwkvModel
+from seqMNIST import SeqMNIST
+
+
+def _key(name):
+    return name.replace('.', '__')
+
+
+class EnsembleModel(nn.Module):
+    """N RwkvModels, forward returns (N, B, output_dim) logits"""
+
+    def __init__(self, input_scan_dim, output_dim, members, **model_kwargs):
+        super().__init__()
+        model_kwargs.setdefault('wkv_chunk_size', 8)
+        model_kwargs['skip_blank_prefix'] = False
+        self.members = [dict(m) for m in members]
+        self.input_scan_dim = input_scan_dim
+        models = []
+        for m in self.members:
+            torch.manual_seed(m.get('seed', 0))
+            models.append(RwkvModel(input_scan_dim, output_dim, **model_kwargs))
+        params, buffers = stack_module_state(models)
+        self.names = list(params)
+        self.params = nn.ParameterDict({_key(k): nn.Parameter(v.detach()) for k, v in params.items()})
+        for k, v in buffers.items():
+            self.register_buffer(_key(k), v)
+        self.buffer_names = list(buffers)
+        # stateless template, kept out of the module tree so it owns no parameters
+        self.__dict__['_template'] = copy.deepcopy(models[0]).to('meta')
+        self._template.gpt_config.wkv_chunk_safe = False
+
+    def __len__(self):
+        return len(self.members)
+
+    def learning_rates(self, default):
+        return torch.tensor([m.get('learning_rate', default) for m in self.members])
+
+    def _member_forward(self, params, buffers, x):
+        return functional_call(self._template, (params, buffers), (x,))
+
+    def forward(self, x):
+        x = x.reshape(x.size(0), -1, self.input_scan_dim)
+        params = {k: self.params[_key(k)] for k in self.names}
+        buffers = {k: getattr(self, _key(k)) for k in self.buffer_names}
+        return vmap(self._member_forward, in_dims=(0, 0, None))(params, buffers, x)
+
+    def member(self, i):
+        """A standalone RwkvModel with the weights of member i"""
+        model = copy.deepcopy(self._template).to_empty(device=self.params[_key(self.names[0])].device)
+        model.gpt_config.wkv_chunk_safe = None
+        state = {k: self.params[_key(k)][i].detach() for k in self.names}
+        state.update({k: getattr(self, _key(k))[i] for k in self.buffer_names})
+        model.load_state_dict(state)
+        return model
+
+
+class StackedAdam(torch.optim.Optimizer):
+    """
+    Adam (same update as torch.optim.Adam) on stacked ensemble parameters with
+    a per-member learning rate, lr is a (N,) tensor broadcast over dim 0.
+    """
+
+    def __init__(self, params, lr, betas=(0.9, 0.999), eps=1e-8):
+        super().__init__(params, dict(lr=torch.as_tensor(lr, dtype=torch.float32), betas=betas, eps=eps))
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                if not state:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
+                state['step'] += 1
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                exp_avg.lerp_(p.grad, 1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
+                bias1 = 1 - beta1 ** state['step']
+                bias2 = 1 - beta2 ** state['step']
+                lr = group['lr'].to(p.device).view(-1, *[1] * (p.dim() - 1))
+                denom = (exp_avg_sq.sqrt() / bias2 ** 0.5).add_(group['eps'])
+                p.addcdiv_(exp_avg * (-lr / bias1), denom)
+        return loss
+
+
+class EnsembleSeqMNIST(SeqMNIST):
+    """SeqMNIST over an EnsembleModel, losses are summed and logged per member"""
+
+    def __init__(self, model, default_batch_size, is_permuted, learning_rate=0.0005, **kwargs):
+        super().__init__(model, learning_rate, default_batch_size, is_permuted, **kwargs)
+
+    def _step(self, batch, prefix):
+        x, y = batch
+        y_hat = self.forward(x)
+        N = y_hat.size(0)
+        losses = F.cross_entropy(y_hat.flatten(0, 1), y.repeat(N), reduction='none').view(N, -1).mean(1)
+        accuracy = (y_hat.argmax(-1) == y).float().mean(1)
+        for i in range(N):
+            self.log(f'{prefix}loss/m{i}', losses[i])
+            self.log(f'{prefix}accuracy/m{i}', accuracy[i])
+        self.log(f'{prefix}loss', losses.mean(), prog_bar=True)
+        self.log(f'{prefix}best_accuracy', accuracy.max(), prog_bar=True)
+        # members are independent, the sum gives every member its own gradient
+        return losses.sum()
+
+    def training_step(self, batch, batch_nb):
+        return self._step(batch, 'train_')
+
+    def validation_step(self, batch, batch_nb):
+        return self._step(batch, 'val_')
+
+    def test_step(self, batch, batch_nb):
+        return self._step(batch, 'test_')
+
+    def configure_optimizers(self):
+        return StackedAdam(self.parameters(), self.model.learning_rates(self.learning_rate))
+
+
+if __name__ == '__main__':
+    # one optimizer step of the ensemble matches independently trained models
+    # (over many steps Adam amplifies float rounding differences between them)
+    members = [dict(seed=0, learning_rate=1e-3), dict(seed=1, learning_rate=3e-3)]
+    ensemble = EnsembleModel(28, 10, members, n_layer=2)
+    singles = [ensemble.member(i) for i in range(len(members))]
+    x, y = torch.rand(16, 28, 28), torch.randint(0, 10, (16,))
+
+    sum(F.cross_entropy(o, y) for o in ensemble(x)).backward()
+    StackedAdam(ensemble.parameters(), ensemble.learning_rates(0)).step()
+    for m, c in zip(singles, members):
+        F.cross_entropy(m(x), y).backward()
+        torch.optim.Adam(m.parameters(), lr=c['learning_rate']).step()
+    diff = max((ensemble.params[_key(n)][i] - p).abs().max().item() for i, m in enumerate(singles) for n, p in m.named_parameters())
+    print('max abs parameter diff', diff)
@@ -0,0 +1,206 @@
+"""
+Fused-weight single-step inference export.
+
+export_fused(model) converts a trained RwkvModel (x060c time mix) into a
+FusedRwkvModel whose per-token step issues a handful of packed GEMMs:
+
+  * ln1 / ln2 affine parameters are folded into every linear map that
+    consumes them. The token-shift mixes are affine combinations of the
+    current and previous LayerNorm outputs (the weights sum to one), so
+    W (g * n + b) splits into (W g) n + W b. The recurrent state then holds
+    the pre-affine normalized inputs, see state_from_legacy / state_to_legacy.
+    A layer whose LayerNorm weight has a zero keeps its affine explicitly.
+  * the time-mix LoRA input and the channel-mix key / receptance are linear
+    in [x, x_prev], each becomes one GEMM on the concatenation.
+  * receptance / key / value run as one baddbmm over the stacked mixed inputs.
+  * ln_x is folded into the output projection, ln_out into the readout.
+  * exp(time_decay) and the time_faaaa bonus are precomputed.
+"""
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from core_rwkv import RWKV_Tmix_x060c
+from rwkv_state import RwkvState
+
+
+def _fold_affine(ln):
+    """(scale, shift, explicit_weight, explicit_bias) for a LayerNorm feeding linear maps"""
+    if bool((ln.weight != 0).all()):
+        return ln.weight, ln.bias, None, None
+    one = torch.ones_like(ln.weight)
+    return one, torch.zeros_like(ln.bias), ln.weight, ln.bias
+
+
+class FusedBlock(nn.Module):
+
+    def __init__(self, block):
+        super().__init__()
+        att, ffn = block.att, block.ffn
+        if not isinstance(att, RWKV_Tmix_x060c):
+            raise TypeError(f'export_fused only supports the x060c time mix, got {type(att).__name__}')
+        self.layer_id = block.layer_id
+        self.n_head = att.n_head
+        self.head_size = att.head_size
+        self.ln0 = block.ln0 if block.layer_id == 0 else None
+        self.eps = block.ln1.eps
+        self.eps_x = att.ln_x.eps
+
+        g1, b1, w1, bb1 = _fold_affine(block.ln1)
+        g2, b2, w2, bb2 = _fold_affine(block.ln2)
+        self.ln1_weight, self.ln1_bias = w1, bb1
+        self.ln2_weight, self.ln2_bias = w2, bb2
+        # affine mapping stored state -> legacy state
+        self.register_buffer('state_att_scale', g1.clone())
+        self.register_buffer('state_att_shift', b1.clone())
+        self.register_buffer('state_ffn_scale', g2.clone())
+        self.register_buffer('state_ffn_shift', b2.clone())
+
+        def cat_mix(weight_t, maa):
+            # (C, out) map applied to x + (x_prev - x) * maa, as one (2C, out) map on [x, x_prev]
+            return torch.cat((weight_t * (1 - maa).view(-1, 1), weight_t * maa.view(-1, 1)), dim=0)
+
+        # time mix lora
+        maa_w1 = g1.view(-1, 1) * att.time_maa_w1
+        self.register_buffer('maa_w1', cat_mix(maa_w1, att.time_maa_x))
+        self.register_buffer('maa_b1', b1 @ att.time_maa_w1)
+        self.register_buffer('maa_w2', att.time_maa_w2.clone())
+        self.register_buffer('maa', torch.stack([att.time_maa_r, att.time_maa_k, att.time_maa_v, att.time_maa_w]).view(4, 1, -1))
+
+        # receptance / key / value stacked, (3, C, A)
+        rkv = torch.stack([att.receptance.weight, att.key.weight, att.value.weight])
+        self.register_buffer('rkv_w', (rkv * g1).transpose(1, 2).contiguous())
+        self.register_buffer('rkv_b', (rkv @ b1).unsqueeze(1))
+
+        self.register_buffer('decay_w1', g1.view(-1, 1) * att.time_decay_w1)
+        self.register_buffer('decay_b1', b1 @ att.time_decay_w1)
+        self.register_buffer('decay_w2', att.time_decay_w2.clone())
+        self.register_buffer('decay_exp', att.time_decay.exp().view(-1))
+        self.register_buffer('bonus', att.time_faaaa.view(att.n_head, att.head_size).clone())
+
+        self.register_buffer('out_w', att.output.weight * att.ln_x.weight)
+        self.register_buffer('out_b', att.output.weight @ att.ln_x.bias)
+
+        # channel mix key / receptance on [x, x_prev], (2C, F + C)
+        kr = torch.cat((ffn.key.weight, ffn.receptance.weight), dim=0)
+        self.dim_ffn = ffn.key.out_features
+        maa_k = ffn.time_maa_k.view(-1)
+        maa_r = ffn.time_maa_r.view(-1)
+        kr_t = (kr * g2).t()
+        self.register_buffer('ffn_w', torch.cat((
+            torch.cat((kr_t[:, :self.dim_ffn] * (1 - maa_k).view(-1, 1), kr_t[:, self.dim_ffn:] * (1 - maa_r).view(-1, 1)), dim=1),
+            torch.cat((kr_t[:, :self.dim_ffn] * maa_k.view(-1, 1), kr_t[:, self.dim_ffn:] * maa_r.view(-1, 1)), dim=1),
+        ), dim=0))
+        self.register_buffer('ffn_b', kr @ b2)
+        self.register_buffer('ffn_value', ffn.value.weight.clone())
+
+    def forward(self, x, state):
+        B, C = x.shape
+        H, S = self.n_head, self.head_size
+        i = self.layer_id
+        if self.ln0 is not None:
+            x = self.ln0(x)
+
+        a = F.layer_norm(x, (C,), self.ln1_weight, self.ln1_bias, self.eps)
+        prev = state.att_x[i]
+        lora = torch.tanh(torch.addmm(self.maa_b1, torch.cat((a, prev), -1), self.maa_w1))
+        m = torch.bmm(lora.view(B, 4, -1).transpose(0, 1), self.maa_w2)
+        u = torch.addcmul(a, prev - a, self.maa + m)
+
+        r, k, v = torch.baddbmm(self.rkv_b, u[:3], self.rkv_w).unbind(0)
+        w = torch.exp(-self.decay_exp * torch.exp(torch.tanh(torch.addmm(self.decay_b1, u[3], self.decay_w1)) @ self.decay_w2))
+        k = k * (1-(-w.exp()).exp())
+
+        r, k, v, w = r.view(B, H, S), k.view(B, H, S), v.view(B, H, S), w.view(B, H, S)
+        s = state.wkv[i]
+        y = (r * self.bonus * k).sum(-1, keepdim=True) * v + (r.unsqueeze(-2) @ s).squeeze(-2)
+        s = torch.addcmul(w.unsqueeze(-1) * s, k.unsqueeze(-1), v.unsqueeze(-2))
+        state = state.update_att(i, a, s)
+
+        x = x + F.linear(F.layer_norm(y.flatten(1), (C,), None, None, self.eps_x), self.out_w, self.out_b)
+
+        f = F.layer_norm(x, (C,), self.ln2_weight, self.ln2_bias, self.eps)
+        kr = torch.addmm(self.ffn_b, torch.cat((f, state.ffn_x[i]), -1), self.ffn_w)
+        state = state.update_ffn(i, f)
+        k, r = kr.split([self.dim_ffn, C], dim=-1)
+        return x + torch.sigmoid(r) * F.linear(torch.square(torch.relu(k)), self.ffn_value), state
+
+
+class FusedRwkvModel(nn.Module):
+    """Single-step equivalent of RwkvModel: (row, state) -> (logits, state)"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.input_scan_dim = model.input_scan_dim
+        self.gpt_config = model.gpt_config
+        self.encoder = model.encoder
+        self.blocks = nn.ModuleList([FusedBlock(b) for b in model.rwkv.blocks])
+        ln_out = model.rwkv.ln_out
+        self.eps = ln_out.eps
+        self.register_buffer('readout_w', model.readout.weight * ln_out.weight)
+        self.register_buffer('readout_b', model.readout.weight @ ln_out.bias + model.readout.bias)
+
+    def step(self, x, state):
+        x = self.encoder(x)
+        for block in self.blocks:
+            x, state = block(x, state)
+        return F.linear(F.layer_norm(x, (x.size(-1),), None, None, self.eps), self.readout_w, self.readout_b), state
+
+    def forward(self, x):
+        x = x.reshape(x.size(0), -1, self.input_scan_dim)
+        state = self.zero_state(x.size(0), device=x.device)
+        for input_t in x.unbind(1):
+            logits, state = self.step(input_t, state)
+        return logits
+
+    def _convert(self, state, to_legacy, inplace=False):
+        att, ffn = [], []
+        for b, xa, xf in zip(self.blocks, state.att_x, state.ffn_x):
+            if to_legacy:
+                att.append(xa * b.state_att_scale + b.state_att_shift)
+                ffn.append(xf * b.state_ffn_scale + b.state_ffn_shift)
+            else:
+                att.append((xa - b.state_att_shift) / b.state_att_scale)
+                ffn.append((xf - b.state_ffn_shift) / b.state_ffn_scale)
+        return RwkvState(att, ffn, [s.clone() for s in state.wkv], inplace=inplace)
+
+    def state_from_legacy(self, state, inplace=False):
+        """RwkvState of the original model -> state of this module"""
+        return self._convert(state, to_legacy=False, inplace=inplace)
+
+    def state_to_legacy(self, state):
+        return self._convert(state, to_legacy=True)
+
+    def zero_state(self, batch_size, device=None, inplace=False):
+        """Equivalent of the original model's all-zero initial state"""
+        return self.state_from_legacy(RwkvState.zeros(self.gpt_config, batch_size, device=device), inplace=inplace)
+
+
+@torch.no_grad()
+def export_fused(model):
+    return FusedRwkvModel(model).eval()
+
+
+if __name__ == '__main__':
+    import time
+
+    from rwkv_model import RwkvModel
+
+    torch.manual_seed(0)
+    model = RwkvModel(28, 10).eval()
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(torch.randn_like(p) * 0.05)
+    fused = export_fused(model)
+    x = torch.rand(64, 1, 28, 28)
+
+    with torch.inference_mode():
+        model.layer_major = False
+        model.skip_blank_prefix = False
+        for name, fn in (('RwkvModel step loop', model), ('FusedRwkvModel', fused)):
+            fn(x)
+            start = time.perf_counter()
+            fn(x)
+            print(f'{name:20s} {(time.perf_counter() - start) * 1e3:8.2f} ms')
+        print('max abs diff', (fused(x) - model(x)).abs().max().item())
@@ -1,32 +1,178 @@
+"""
+Train RwkvModel on sequential MNIST.
+
+    python main.py --max-epochs 100
+    python main.py --input-scan-dim 1 --permuted --bptt checkpoint
+    python main.py --config run.json --learning-rate 1e-3   # flags override the JSON
+    python main.py --input-scan-dim 1 --memory-budget 2G    # batch split into accumulation steps to fit
+
+Multi-process CPU data parallel (gloo), one process per --num-processes,
+each with --threads intra-op threads:
+
+    python main.py --num-processes 4 --threads 2
+    # across nodes, env rendezvous (run on every node with its --node-rank)
+    python main.py --num-processes 4 --num-nodes 2 --node-rank 0 --master-addr 10.0.0.1 --master-port 29500
+    # or a file on a shared filesystem, nothing listens on the network
+    python main.py --num-processes 4 --num-nodes 2 --node-rank 0 --rendezvous file:///shared/rdzv-run1
+"""
+
+import argparse
+import json
+import os
+
 from seqMNIST import *
 from tqdm import tqdm
 from pytorch_lightning import Trainer
+from pytorch_lightning.strategies import DDPStrategy
+from lightning_fabric.utilities.seed import reset_seed
 from rwkv_model import RwkvModel
-from test_tube import Experiment
+import memory_planner
 tqdm.monitor_interval = 0
-AVAIL_GPUS = min(1, torch.cuda.device_count())
 torch.set_float32_matmul_precision('medium')
 
-def main():
 
+class FileRendezvousDDPStrategy(DDPStrategy):
+    """DDP whose process group meets through init_method (e.g. file:///path) instead of MASTER_ADDR / MASTER_PORT"""
+
+    def __init__(self, init_method, **kwargs):
+        super().__init__(**kwargs)
+        self.init_method = init_method
+
+    def setup_distributed(self):
+        reset_seed()
+        self.set_world_ranks()
+        self._process_group_backend = self._get_process_group_backend()
+        if not torch.distributed.is_initialized():
+            torch.distributed.init_process_group(self._process_group_backend, init_method=self.init_method,
+                                                 rank=self.global_rank, world_size=self.world_size, timeout=self._timeout)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default=None, help='JSON file of defaults for any of the options below (keys as dest names)')
+
+    model = parser.add_argument_group('model')
     # input_scan_dim=28 is row-by-row sequential MNIST
     # input_scan_dim=1 to make it pixel-by-pixel
-    input_scan_dim = 28
-    output_dim = 10
-    learning_rate = 0.0005
-    batch_size = 256
-    gradient_clip = 2.0
-    is_permuted = False
-    max_epochs = 100
-    percent_validation = 0.2
-
-    gpus = None
-    if torch.cuda.is_available():
-        gpus = [0]
-
-    model = RwkvModel(input_scan_dim, output_dim)
-    lightning_module = SeqMNIST(model, learning_rate, batch_size, is_permuted, percent_validation)
-    trainer = Trainer(max_epochs=5)
+    model.add_argument('--input-scan-dim', type=int, default=28)
+    model.add_argument('--output-dim', type=int, default=10)
+    model.add_argument('--n-layer', type=int, default=4)
+    model.add_argument('--n-embd', type=int, default=64)
+    model.add_argument('--tmix', default='x060c', choices=['x060c', 'x060'])
+    model.add_argument('--wkv-mode', default='chunked', choices=['recurrent', 'chunked', 'checkpoint'])
+    model.add_argument('--wkv-chunk-size', type=int, default=16)
+    model.add_argument('--wkv-checkpoint-every', type=int, default=16)
+    model.add_argument('--no-layer-major', dest='layer_major', action='store_false')
+    model.add_argument('--no-skip-blank-prefix', dest='skip_blank_prefix', action='store_false')
+
+    data = parser.add_argument_group('training')
+    data.add_argument('--learning-rate', type=float, default=0.0005)
+    data.add_argument('--batch-size', type=int, default=256, help='per process')
+    data.add_argument('--accumulate-grad-batches', type=int, default=1)
+    data.add_argument('--gradient-clip', type=float, default=2.0)
+    data.add_argument('--permuted', dest='is_permuted', action='store_true')
+    data.add_argument('--max-epochs', type=int, default=100)
+    data.add_argument('--limit-train-batches', type=float, default=None, help='fraction, or number of batches if > 1')
+    data.add_argument('--limit-val-batches', type=float, default=None)
+    data.add_argument('--percent-validation', type=float, default=0.2)
+    data.add_argument('--data-seed', type=int, default=0)
+    data.add_argument('--data-root', default=None)
+    data.add_argument('--seed', type=int, default=None, help='seeds model init in every process')
+    data.add_argument('--bptt', default='full', choices=['full', 'checkpoint', 'truncated'])
+    data.add_argument('--bptt-window', type=int, default=None)
+    data.add_argument('--exit-loss-interval', type=int, default=None, help='also train the readout every that many steps (early exit)')
+    data.add_argument('--exit-loss-weight', type=float, default=1.0)
+    data.add_argument('--profile-hotpath', action='store_true')
+    data.add_argument('--trace-dir', default=None, help='write a Chrome trace of a window of training steps here')
+    data.add_argument('--trace-start', type=int, default=10, help='global step the trace starts at')
+    data.add_argument('--trace-steps', type=int, default=5)
+
+    dist = parser.add_argument_group('hardware')
+    dist.add_argument('--gpus', type=int, default=None, help='number of GPUs, default 1 if available, 0 runs on CPU')
+    dist.add_argument('--num-processes', type=int, default=1, help='CPU data-parallel processes per node')
+    dist.add_argument('--num-nodes', type=int, default=1)
+    dist.add_argument('--node-rank', type=int, default=None)
+    dist.add_argument('--rendezvous', default='env', help="'env' (MASTER_ADDR / MASTER_PORT) or an init_method such as file:///path")
+    dist.add_argument('--master-addr', default=None)
+    dist.add_argument('--master-port', type=int, default=None)
+    dist.add_argument('--threads', type=int, default=None, help='intra-op threads per process, default cores / processes')
+    dist.add_argument('--memory-budget', default=None,
+                      help="per-process memory for training, e.g. 2G: --batch-size becomes the effective batch, split into micro batches that fit")
+    dist.add_argument('--pin-cores', action='store_true', help='bind each process to its own block of cores')
+
+    args, _ = parser.parse_known_args(argv)
+    if args.config:
+        with open(args.config) as f:
+            parser.set_defaults(**json.load(f))
+    return parser.parse_args(argv)
+
+
+def pin_threads(args):
+    """Per-process thread count and optional core affinity, derived from the local rank"""
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    # Lightning launches ranks 1.. from rank 0 after it pinned itself and affinity is
+    # inherited, so the launcher records the unpinned core set for its children
+    if 'SEQMNIST_CORES' not in os.environ:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        os.environ['SEQMNIST_CORES'] = ','.join(map(str, cores))
+    cores = [int(c) for c in os.environ['SEQMNIST_CORES'].split(',')]
+    threads = args.threads or max(1, len(cores) // args.num_processes)
+    if args.pin_cores and hasattr(os, 'sched_setaffinity'):
+        block = cores[local_rank * threads:(local_rank + 1) * threads]
+        if block:
+            os.sched_setaffinity(0, block)
+    torch.set_num_threads(threads)
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+
+
+def build_trainer(args):
+    gpus = args.gpus if args.gpus is not None else min(1, torch.cuda.device_count())
+    kwargs = dict(max_epochs=args.max_epochs, gradient_clip_val=args.gradient_clip or None, num_nodes=args.num_nodes,
+                  accumulate_grad_batches=args.accumulate_grad_batches)
+    for name in ('limit_train_batches', 'limit_val_batches'):
+        value = getattr(args, name)
+        if value is not None:
+            kwargs[name] = int(value) if value > 1 else value
+    if gpus:
+        kwargs.update(accelerator='gpu', devices=gpus)
+    else:
+        kwargs.update(accelerator='cpu', devices=args.num_processes)
+
+    if args.num_processes * args.num_nodes > 1 and not gpus:
+        if args.master_addr:
+            os.environ['MASTER_ADDR'] = args.master_addr
+        if args.master_port:
+            os.environ['MASTER_PORT'] = str(args.master_port)
+        if args.node_rank is not None:
+            os.environ['NODE_RANK'] = str(args.node_rank)
+        if args.rendezvous == 'env':
+            kwargs['strategy'] = DDPStrategy(process_group_backend='gloo')
+        else:
+            kwargs['strategy'] = FileRendezvousDDPStrategy(args.rendezvous, process_group_backend='gloo')
+    return Trainer(**kwargs)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    pin_threads(args)
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+
+    model = RwkvModel(args.input_scan_dim, args.output_dim, n_layer=args.n_layer, n_embd=args.n_embd, tmix=args.tmix,
+                      layer_major=args.layer_major, wkv_mode=args.wkv_mode, wkv_chunk_size=args.wkv_chunk_size,
+                      wkv_checkpoint_every=args.wkv_checkpoint_every, skip_blank_prefix=args.skip_blank_prefix)
+    if args.memory_budget:
+        p = memory_planner.plan(model, 28 * 28 // args.input_scan_dim, memory_planner.parse_size(args.memory_budget),
+                                args.batch_size * args.accumulate_grad_batches, bptt=args.bptt, bptt_window=args.bptt_window)
+        args.batch_size, args.accumulate_grad_batches = p.batch_size, p.accumulate_grad_batches
+        print(f'memory plan: batch {p.batch_size} x {p.accumulate_grad_batches} accumulation steps, '
+              f'~{p.estimate_bytes / 2**20:.0f} MiB per process')
+    lightning_module = SeqMNIST(model, args.learning_rate, args.batch_size, args.is_permuted, args.percent_validation,
+                                data_seed=args.data_seed, data_root=args.data_root, profile_hotpath=args.profile_hotpath,
+                                trace_dir=args.trace_dir, trace_start=args.trace_start, trace_steps=args.trace_steps,
+                                bptt=args.bptt, bptt_window=args.bptt_window,
+                                exit_loss_interval=args.exit_loss_interval, exit_loss_weight=args.exit_loss_weight)
+    trainer = build_trainer(args)
     trainer.fit(lightning_module)
 
 
@@ -0,0 +1,169 @@
+"""
+Batch size / gradient accumulation planner.
+
+estimate() models peak memory of RwkvModel analytically from the RWKV config
+(n_layer, n_embd, head_size_a, dim_ffn), the sequence length, the batch size
+and the training mode:
+
+    fixed       the model's parameters (+ gradients and two Adam moments when training)
+    state       n_layer * (2 + S) * n_embd floats per sample
+    activations tensors autograd keeps per sample: all T steps of every layer
+                for full BPTT, one window plus the boundary states for the
+                segmented modes, a single layer's transient when inferring
+
+probe() runs a few real training steps at small batch sizes over the stretch
+of steps the mode keeps a graph for and measures the bytes autograd saves,
+which corrects the per-token activation term.
+plan() then picks the largest batch that fits a budget, splitting the
+requested batch into gradient-accumulation micro batches when it doesn't.
+"""
+
+import math
+import types
+
+import torch
+
+FLOAT = 4
+# allocator fragmentation, autograd temporaries and the data batch
+HEADROOM = 1.25
+
+
+def parse_size(text):
+    """'2G', '512M', '1.5GiB' or a plain byte count"""
+    text = str(text).strip().upper().removesuffix('IB').removesuffix('B')
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+
+def _dims(config):
+    C = config['n_embd']
+    S = config.get('head_size_a', 64)
+    return config['n_layer'], C, C // S, S, int((C * 3.5) // 32 * 32)
+
+
+def activation_floats_per_token(config):
+    """Floats autograd keeps per token and layer, counted from the layer-major forward"""
+    L, C, H, S, F = _dims(config)
+    chunk = config.get('wkv_chunk_size', 16)
+    # x060 has a fifth (gate) mix and the gate projection
+    mixes = 5 if config.get('tmix', 'x060c') == 'x060' else 4
+    tmix = (20 + mixes) * C + 2 * 32 * mixes + 2 * 64
+    cmix = 3 * F + 7 * C
+    wkv = 6 * C + H * chunk + H * S * S / chunk
+    return tmix + cmix + wkv + 4 * C
+
+
+def _window(seq_len, bptt, bptt_window):
+    # the graph forward_segmented holds at once covers this many steps
+    return seq_len if bptt == 'full' else min(bptt_window or math.isqrt(seq_len - 1) + 1, seq_len)
+
+
+def estimate(model, seq_len, batch_size, training=True, bptt='full', bptt_window=None, activation_scale=1.0):
+    """Peak bytes, see the module docstring; activation_scale comes from probe()"""
+    config = model.config()
+    L, C, H, S, F = _dims(config)
+    fixed = sum(p.numel() for p in model.parameters()) * FLOAT * (4 if training else 1)
+    state = L * (2 + S) * C * FLOAT
+    per_token = activation_floats_per_token(config) * FLOAT * activation_scale
+    window = _window(seq_len, bptt, bptt_window)
+    if not training:
+        per_sample = state + seq_len * per_token
+    elif bptt == 'full':
+        per_sample = state + L * seq_len * per_token
+    elif bptt == 'checkpoint':
+        # boundary states kept for backward, plus one segment's graph while it is recomputed
+        per_sample = state * (-(-seq_len // window) + 1) + L * window * per_token
+    elif bptt == 'truncated':
+        # the head runs without a graph, one layer at a time
+        per_sample = state * 2 + max(L * window * per_token, (seq_len - window) * per_token)
+    else:
+        raise ValueError(f'unknown bptt mode {bptt!r}')
+    return int(HEADROOM * (fixed + batch_size * per_sample))
+
+
+def _saved_bytes(model, x, y):
+    """Bytes autograd saves for one full-BPTT step; nothing is freed before backward, so this is the peak"""
+    seen = {}
+
+    def pack(t):
+        seen[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        torch.nn.functional.cross_entropy(model(x), y).backward()
+    return sum(seen.values())
+
+
+def probe(model, seq_len, training=True, bptt='full', bptt_window=None, batch_sizes=(2, 4)):
+    """
+    Ratio of the measured to the analytic per-token activation bytes. Runs
+    full-BPTT training steps over the longest stretch the mode keeps a graph
+    for (the whole sequence, or one window: a checkpointed segment being
+    recomputed is exactly that) at two small batch sizes, whose difference
+    cancels the batch-independent part. 1.0 when not training.
+    """
+    if not training:
+        return 1.0
+    config = model.config()
+    T = _window(seq_len, bptt, bptt_window)
+    measured = []
+    for B in batch_sizes:
+        x = torch.rand(B, T, model.input_scan_dim)
+        y = torch.randint(0, config['output_dim'], (B,))
+        model.zero_grad(set_to_none=True)
+        measured.append(_saved_bytes(model, x, y))
+    model.zero_grad(set_to_none=True)
+    per_sample = (measured[1] - measured[0]) / (batch_sizes[1] - batch_sizes[0])
+    predicted = config['n_layer'] * T * activation_floats_per_token(config) * FLOAT
+    return per_sample / predicted
+
+
+def plan(model, seq_len, budget, batch_size=256, training=True, bptt='full', bptt_window=None, run_probe=True):
+    """
+    SimpleNamespace(batch_size, accumulate_grad_batches, estimate_bytes, activation_scale).
+
+    Keeps the effective batch at batch_size: if it doesn't fit the budget the
+    largest fitting micro batch is used with gradient accumulation.
+    """
+    scale = probe(model, seq_len, training, bptt, bptt_window) if run_probe else 1.0
+
+    def cost(B):
+        return estimate(model, seq_len, B, training, bptt, bptt_window, scale)
+
+    if cost(1) > budget:
+        raise ValueError(f'even batch size 1 needs ~{cost(1) / 2**20:.0f} MiB, over the {budget / 2**20:.0f} MiB budget')
+    micro = batch_size
+    if cost(batch_size) > budget:
+        lo, hi = 1, batch_size
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            lo, hi = (mid, hi) if cost(mid) <= budget else (lo, mid - 1)
+        micro = lo
+    accumulate = -(-batch_size // micro)
+    # spread the batch evenly over the accumulation steps
+    micro = -(-batch_size // accumulate)
+    return types.SimpleNamespace(batch_size=micro, accumulate_grad_batches=accumulate,
+                                 estimate_bytes=cost(micro), activation_scale=scale)
+
+
+if __name__ == '__main__':
+    from rwkv_model import RwkvModel
+
+    torch.manual_seed(0)
+    model = RwkvModel(28, 10)
+    T = 28
+    for bptt in ('full', 'checkpoint', 'truncated'):
+        p = plan(model, T, parse_size('256M'), bptt=bptt)
+        B, window = p.batch_size, _window(T, bptt, None)
+        # measured: saved tensors of the graph over one window (all of T for full BPTT);
+        # the recurrent states the mode holds on top are exact sizes, added as counted
+        x, y = torch.rand(B, window, 28), torch.randint(0, 10, (B,))
+        saved = _saved_bytes(model, x, y)
+        state = model.gpt_config.n_layer * 66 * 64 * FLOAT
+        saved += B * state * {'full': 1, 'checkpoint': -(-T // window) + 1, 'truncated': 2}[bptt]
+        fixed = sum(q.numel() for q in model.parameters()) * FLOAT * 4
+        measured = HEADROOM * (fixed + saved)
+        print(f'{bptt:10s} batch {B:3d} x {p.accumulate_grad_batches}  estimate {p.estimate_bytes / 2**20:6.1f} MiB  '
+              f'measured {measured / 2**20:6.1f} MiB  ratio {p.estimate_bytes / measured:.2f}')
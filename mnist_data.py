@@ -0,0 +1,123 @@
+"""
+Tensor-backed MNIST pipeline.
+
+The whole dataset is a (N, 28, 28) uint8 tensor (~47 MB for the training
+split), so instead of decoding PIL images one by one in DataLoader workers we
+keep it in one contiguous tensor and do shuffling, batching and the float
+conversion as whole-batch tensor ops in the training process.
+"""
+
+import os
+
+import numpy as np
+import torch
+from torchvision.datasets import MNIST
+
+
+def load_mnist(root, train, mmap=True):
+    """
+    Returns (images, labels) as uint8 (N, 28, 28) and int64 (N,) tensors.
+
+    The raw files are decoded once through torchvision and cached next to them
+    as .npy, later calls memory-map the cache (copy-on-write, so the tensors
+    stay writable) instead of reading the whole file up front.
+    """
+    split = 'train' if train else 'test'
+    cache_dir = os.path.join(root, 'MNIST', 'cache')
+    images_path = os.path.join(cache_dir, f'{split}-images.npy')
+    labels_path = os.path.join(cache_dir, f'{split}-labels.npy')
+
+    if not (os.path.exists(images_path) and os.path.exists(labels_path)):
+        dataset = MNIST(root, train=train, download=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(images_path, dataset.data.numpy())
+        np.save(labels_path, dataset.targets.numpy())
+        return dataset.data, dataset.targets
+
+    mmap_mode = 'c' if mmap else None
+    images = torch.from_numpy(np.load(images_path, mmap_mode=mmap_mode))
+    labels = torch.from_numpy(np.load(labels_path, mmap_mode=mmap_mode))
+    return images, labels
+
+
+def split_indices(n, percent_validation, seed=0):
+    """Reproducible (train, val) index split of range(n)"""
+    assert 0 <= percent_validation < 1
+    val_nb = round(n * percent_validation)
+    perm = torch.randperm(n, generator=torch.Generator().manual_seed(seed))
+    return perm[val_nb:], perm[:val_nb]
+
+
+class TensorBatchLoader:
+    """
+    Iterable of (x, y) batches drawn from uint8 image / label tensors.
+
+    x is float in [0, 1] with shape (B, 1, 28, 28), exactly what
+    transforms.ToTensor() produced, optionally normalized with (mean, std).
+    With shuffle=True every pass uses a fresh permutation seeded by
+    seed + epoch, so runs are reproducible.
+
+    With num_replicas > 1 each rank iterates its own interleaved shard of
+    that (shared) order, padded by wrapping around so every rank runs the
+    same number of batches, like DistributedSampler.
+    """
+
+    def __init__(self, images, labels, batch_size, shuffle=False, seed=0, drop_last=False, normalize=None, device=None,
+                 num_replicas=1, rank=0):
+        assert 0 <= rank < num_replicas
+        if device is not None:
+            images = images.to(device)
+            labels = labels.to(device)
+        self.images = images
+        self.labels = labels.long()
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.normalize = normalize
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def _num_samples(self):
+        return -(-len(self.labels) // self.num_replicas)
+
+    def __len__(self):
+        n = self._num_samples()
+        if self.drop_last:
+            return n // self.batch_size
+        return -(-n // self.batch_size)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _order(self):
+        n = len(self.labels)
+        if self.shuffle:
+            g = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(n, generator=g)
+        elif self.num_replicas > 1:
+            order = torch.arange(n)
+        else:
+            return None
+        if self.num_replicas > 1:
+            total = self._num_samples() * self.num_replicas
+            order = torch.cat((order, order[:total - n]))[self.rank::self.num_replicas]
+        return order.to(self.labels.device)
+
+    def __iter__(self):
+        order = self._order()
+        self.epoch += 1
+        for b in range(len(self)):
+            if order is None:
+                sl = slice(b * self.batch_size, (b + 1) * self.batch_size)
+                x, y = self.images[sl], self.labels[sl]
+            else:
+                idx = order[b * self.batch_size:(b + 1) * self.batch_size]
+                x, y = self.images[idx], self.labels[idx]
+
+            x = x.unsqueeze(1).float().div_(255)
+            if self.normalize is not None:
+                mean, std = self.normalize
+                x = x.sub_(mean).div_(std)
+            yield x, y
@@ -0,0 +1,149 @@
+"""
+Wavefront execution of the per-timestep loop.
+
+Layer l at step t needs only layer l-1 at step t and its own state from step
+t-1, so with the blocks split into stages (one worker thread each) stage 0
+can run step t+1 while stage 1 runs step t. Activations move between stages
+through preallocated ring buffers guarded by a pair of semaphores, and every
+stage owns the state of its own layers, so nothing else is shared.
+
+This cuts wall-clock latency of a single long sequence (B=1 streaming) when
+there is no batch to parallelize over; the torch kernels release the GIL, so
+stages overlap on separate cores.
+"""
+
+import threading
+
+import torch
+
+from rwkv_state import RwkvState
+
+
+class _Ring:
+    """Single-producer single-consumer ring of preallocated (B, C) slots"""
+
+    def __init__(self, depth, shape, dtype, device):
+        self.buf = torch.empty(depth, *shape, dtype=dtype, device=device)
+        self.depth = depth
+        self.free = threading.Semaphore(depth)
+        self.filled = threading.Semaphore(0)
+
+    def put(self, t, x):
+        self.free.acquire()
+        self.buf[t % self.depth].copy_(x)
+        self.filled.release()
+
+    def get(self, t):
+        self.filled.acquire()
+        return self.buf[t % self.depth]
+
+    def done(self):
+        self.free.release()
+
+    def abort(self):
+        # wake anyone blocked on this ring after a worker failed
+        for _ in range(self.depth + 1):
+            self.free.release()
+            self.filled.release()
+
+
+class WavefrontPipeline:
+    """
+    Runs RwkvModel's step loop with the blocks split over num_stages threads.
+
+        pipe = WavefrontPipeline(model, num_stages=4)
+        logits, state = pipe.run(x)              # x (B, T, input_scan_dim), B is usually 1
+        logits, state = pipe.run(x2, state)      # continue the same sequences
+    """
+
+    def __init__(self, model, num_stages=None, depth=4):
+        self.model = model.eval()
+        blocks = list(model.rwkv.blocks)
+        num_stages = min(num_stages or len(blocks), len(blocks))
+        bounds = [round(i * len(blocks) / num_stages) for i in range(num_stages + 1)]
+        self.stages = [blocks[a:b] for a, b in zip(bounds, bounds[1:])]
+        self.depth = depth
+        self._rings = {}
+
+    def _rings_for(self, B, dtype, device):
+        key = (B, dtype, device)
+        if key not in self._rings:
+            shape = (B, self.model.gpt_config.n_embd)
+            self._rings[key] = [_Ring(self.depth, shape, dtype, device) for _ in range(len(self.stages) - 1)]
+        return self._rings[key]
+
+    def _stage(self, k, x, s, inbox, outbox, result):
+        T = x.size(1)
+        for t in range(T):
+            h = self.model.encoder(x[:, t]) if inbox is None else inbox.get(t)
+            for block in self.stages[k]:
+                h, s = block(h, s)
+            if inbox is not None:
+                inbox.done()
+            if outbox is not None:
+                outbox.put(t, h)
+            elif t == T - 1:
+                result[0] = self.model.readout(self.model.rwkv.ln_out(h))
+        return s
+
+    @torch.inference_mode()
+    def run(self, x, state=None):
+        """Returns the logits after the last step and the final RwkvState"""
+        x = x.reshape(x.size(0), -1, self.model.input_scan_dim)
+        B = x.size(0)
+        if state is None:
+            state = RwkvState.zeros(self.model.gpt_config, B, device=x.device)
+        rings = self._rings_for(B, x.dtype, x.device)
+        states = [state] * len(self.stages)
+        result = [None]
+        errors = []
+
+        def work(k):
+            inbox = rings[k - 1] if k > 0 else None
+            outbox = rings[k] if k < len(rings) else None
+            try:
+                # grad mode is thread local
+                with torch.inference_mode():
+                    states[k] = self._stage(k, x, states[k], inbox, outbox, result)
+            except BaseException as e:
+                errors.append(e)
+                for ring in rings:
+                    ring.abort()
+
+        threads = [threading.Thread(target=work, args=(k,), daemon=True) for k in range(len(self.stages))]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        if errors:
+            # the aborted rings hold stale permits, start over next time
+            self._rings.pop((B, x.dtype, x.device), None)
+            raise errors[0]
+
+        # every stage updated only its own layers
+        L = self.model.gpt_config.n_layer
+        owner = [k for k, blocks in enumerate(self.stages) for _ in blocks]
+        final = RwkvState([states[owner[i]].att_x[i] for i in range(L)],
+                          [states[owner[i]].ffn_x[i] for i in range(L)],
+                          [states[owner[i]].wkv[i] for i in range(L)])
+        return result[0], final
+
+
+if __name__ == '__main__':
+    import time
+
+    from rwkv_model import RwkvModel
+
+    torch.manual_seed(0)
+    model = RwkvModel(1, 10, layer_major=False, skip_blank_prefix=False).eval()
+    x = torch.rand(1, 784, 1)
+    pipe = WavefrontPipeline(model)
+    with torch.inference_mode():
+        start = time.perf_counter()
+        ref = model(x)
+        sequential = time.perf_counter() - start
+    start = time.perf_counter()
+    out, _ = pipe.run(x)
+    piped = time.perf_counter() - start
+    print(f'sequential {sequential * 1e3:8.1f} ms  wavefront ({len(pipe.stages)} stages) {piped * 1e3:8.1f} ms  '
+          f'max abs diff {(out - ref).abs().max().item():.2e}')
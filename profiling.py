@@ -0,0 +1,66 @@
+"""
+Opt-in timing of the model's hot-path regions.
+
+The layers wrap their sections in `with hotpath.region('name'):`. While the
+profiler is disabled that is a single attribute check returning a shared
+null context; once enabled every region records its wall time (synchronising
+CUDA first so the numbers mean something) and shows up as a named range in
+torch.profiler traces. Regions nest, an outer region includes its children.
+"""
+
+import collections
+import contextlib
+import time
+
+import torch
+
+_NULL = contextlib.nullcontext()
+
+
+class _Region:
+    __slots__ = ('owner', 'name', 'start', 'record')
+
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+
+    def __enter__(self):
+        self.record = torch.profiler.record_function(self.name)
+        self.record.__enter__()
+        if self.owner.cuda_sync:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.owner.cuda_sync:
+            torch.cuda.synchronize()
+        self.owner.samples[self.name].append(time.perf_counter() - self.start)
+        self.record.__exit__(*exc)
+
+
+class HotPathProfiler:
+
+    def __init__(self):
+        self.enabled = False
+        self.cuda_sync = False
+        self.samples = collections.defaultdict(list)
+
+    def region(self, name):
+        if not self.enabled:
+            return _NULL
+        return _Region(self, name)
+
+    def enable(self, cuda_sync=None):
+        self.enabled = True
+        self.cuda_sync = torch.cuda.is_available() if cuda_sync is None else cuda_sync
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """Returns the collected per-call durations (seconds) by region and clears them"""
+        samples, self.samples = self.samples, collections.defaultdict(list)
+        return dict(samples)
+
+
+hotpath = HotPathProfiler()
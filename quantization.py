@@ -0,0 +1,155 @@
+"""
+Quantized CPU inference.
+
+quantize_model(model, mode) returns a copy of a RwkvModel whose nn.Linear
+projections (time mix, channel mix, encoder, readout) are replaced:
+
+  * 'int8'         int8 weights (per output channel), activations quantized
+                   per row on the fly, int8 x int8 -> int32 GEMM
+  * 'int8-static'  same, with per-layer activation scales from calibrate()
+  * 'bf16'         bf16 weights and activations
+
+Every quantized layer returns fp32, so the LoRA mixes, the decay w and the
+per-head S x S WKV state keep accumulating in fp32 over long scans.
+"""
+
+import copy
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+MODES = ('fp32', 'int8', 'int8-static', 'bf16')
+
+
+class Int8Linear(nn.Module):
+
+    def __init__(self, linear, act_scale=None):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        weight = linear.weight.detach().float()
+        w_scale = weight.abs().amax(1).clamp_min(1e-8) / 127
+        q = torch.round(weight / w_scale.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+        # (in, out) row-major int8, the layout _int_mm expects for the right operand; .t().contiguous()
+        # is a no-op for in_features == 1 and leaves strides _int_mm misreads
+        weight_q = torch.empty(self.in_features, self.out_features, dtype=torch.int8, device=weight.device)
+        self.register_buffer('weight_q', weight_q.copy_(q.t()))
+        self.register_buffer('weight_scale', w_scale)
+        self.register_buffer('bias', None if linear.bias is None else linear.bias.detach().float().clone())
+        self.register_buffer('act_scale', None if act_scale is None else torch.tensor(float(act_scale)))
+
+    def forward(self, x):
+        shape = x.shape
+        x = x.reshape(-1, self.in_features).float()
+        if self.act_scale is None:
+            scale = x.abs().amax(1, keepdim=True).clamp_min(1e-8) / 127
+        else:
+            scale = self.act_scale
+        xq = torch.round(x / scale).clamp_(-127, 127).to(torch.int8)
+        y = torch._int_mm(xq, self.weight_q).float() * (scale * self.weight_scale)
+        if self.bias is not None:
+            y = y + self.bias
+        return y.view(*shape[:-1], self.out_features)
+
+    def extra_repr(self):
+        static = 'static' if self.act_scale is not None else 'dynamic'
+        return f'in_features={self.in_features}, out_features={self.out_features}, {static}'
+
+
+class Bf16Linear(nn.Module):
+
+    def __init__(self, linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.register_buffer('weight', linear.weight.detach().to(torch.bfloat16))
+        self.register_buffer('bias', None if linear.bias is None else linear.bias.detach().to(torch.bfloat16))
+
+    def forward(self, x):
+        return F.linear(x.to(torch.bfloat16), self.weight, self.bias).float()
+
+
+def _linears(model):
+    return [(name, m) for name, m in model.named_modules() if isinstance(m, nn.Linear)]
+
+
+@torch.no_grad()
+def calibrate(model, batches, max_batches=None):
+    """
+    Runs batches of model inputs through an fp32 model and returns the absolute
+    maximum input of every nn.Linear, by module name, for 'int8-static'.
+    """
+    amax = {}
+    hooks = []
+    for name, m in _linears(model):
+        def hook(module, args, name=name):
+            value = args[0].detach().abs().max().item()
+            amax[name] = max(amax.get(name, 0.0), value)
+        hooks.append(m.register_forward_pre_hook(hook))
+    try:
+        model.eval()
+        for i, x in enumerate(batches):
+            if max_batches is not None and i >= max_batches:
+                break
+            model(x)
+    finally:
+        for h in hooks:
+            h.remove()
+    return {name: v / 127 for name, v in amax.items()}
+
+
+def calibrate_seqmnist(lightning_module, max_batches=16):
+    """Activation scales from the SeqMNIST validation split, through its forward (so permutation applies)"""
+    lightning_module.setup('validate')
+    batches = (x for x, _ in lightning_module.val_dataloader())
+    scales = calibrate(lightning_module, batches, max_batches)
+    # the hooks see names relative to the lightning module
+    return {name.removeprefix('model.'): v for name, v in scales.items()}
+
+
+@torch.no_grad()
+def quantize_model(model, mode='int8', act_scales=None):
+    """Quantized copy of model, see the module docstring for the modes"""
+    if mode not in MODES:
+        raise ValueError(f'unknown mode {mode!r}, expected one of {MODES}')
+    model = copy.deepcopy(model).eval()
+    if mode == 'fp32':
+        return model
+    if mode == 'int8-static' and act_scales is None:
+        raise ValueError("mode 'int8-static' needs act_scales, see calibrate()")
+
+    for name, linear in _linears(model):
+        if mode == 'bf16':
+            new = Bf16Linear(linear)
+        else:
+            new = Int8Linear(linear, act_scales[name] if mode == 'int8-static' else None)
+        parent_name, _, attr = name.rpartition('.')
+        setattr(model.get_submodule(parent_name), attr, new)
+    # quantized layers hold buffers, drop anything memoized with the fp32 weights
+    model.invalidate_blank_cache()
+    return model
+
+
+def model_size_bytes(model):
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+if __name__ == '__main__':
+    from rwkv_model import RwkvModel
+
+    torch.manual_seed(0)
+    # row by row, and pixel by pixel (the encoder is a 1-input linear)
+    for scan, B in ((28, 32), (1, 4)):
+        model = RwkvModel(scan, 10).eval()
+        x = torch.rand(B, 1, 28, 28)
+        scales = calibrate(model, [torch.rand(B, 1, 28, 28) for _ in range(4)])
+        with torch.inference_mode():
+            ref = model(x)
+            for mode in MODES:
+                q = quantize_model(model, mode, scales)
+                out = q(x)
+                print(f'scan {scan:2d} {mode:12s} {model_size_bytes(q) / 2**10:8.1f} KiB  '
+                      f'max abs diff {(out - ref).abs().max().item():.2e}  '
+                      f'argmax agreement {(out.argmax(1) == ref.argmax(1)).float().mean().item():.0%}')
@@ -1,18 +1,38 @@
+import contextlib
+import hashlib
+import math
+
 import torch
+import torch.utils.checkpoint
 from core_rwkv import RWKV
+from rwkv_state import RwkvState
 import types
 
 class RwkvModel(torch.nn.Module):
 
-    def __init__(self, input_scan_dim, output_dim):
+    def __init__(self, input_scan_dim, output_dim, n_layer=4, n_embd=64, tmix='x060c', layer_major=True, wkv_mode='chunked', wkv_chunk_size=16, wkv_checkpoint_every=16,
+                 skip_blank_prefix=True, blank_prefix_granularity=None):
         super(RwkvModel, self).__init__()
         self.input_scan_dim = input_scan_dim
+        # layer_major=True runs each block over the whole sequence at once,
+        # False keeps the original timestep-by-timestep loop
+        self.layer_major = layer_major
+        # start samples whose scan begins with all-zero rows from a memoized
+        # "k blank rows" state instead of recomputing it for every sample
+        self.skip_blank_prefix = skip_blank_prefix
+        self.blank_prefix_granularity = blank_prefix_granularity
+        self._blank_cache = None
 
         tmp = types.SimpleNamespace()
-        tmp.n_layer = 4
-        tmp.n_embd = 64
+        tmp.n_layer = n_layer
+        tmp.n_embd = n_embd
         tmp.head_size_a = 64 # don't change
         tmp.head_size_divisor = 8 # don't change
+        tmp.tmix = tmix # "x060c" or "x060" (with gate and GroupNorm)
+        # WKV kernel used by the layer-major path, see wkv.run_wkv
+        tmp.wkv_mode = wkv_mode
+        tmp.wkv_chunk_size = wkv_chunk_size
+        tmp.wkv_checkpoint_every = wkv_checkpoint_every
         self.gpt_config = tmp
 
         self.encoder = torch.nn.Linear(input_scan_dim, tmp.n_embd)
@@ -23,12 +43,226 @@ class RwkvModel(torch.nn.Module):
         else:
             self.device = torch.device('cpu')
 
+    @classmethod
+    def from_checkpoint(cls, path, map_location='cpu', meta=False, **kwargs):
+        """
+        Loads a RwkvModel state_dict or SeqMNIST Lightning checkpoint.
+        Architecture sizes are read from the weights, the remaining constructor
+        options can be passed as kwargs.
+
+        With meta=True the model is built on the meta device and materialized
+        straight from the checkpoint tensors, so no parameter is allocated or
+        initialized twice. That pays off for large models; the first use of the
+        meta device costs a one-off ~1.5 s of lazy torch imports.
+        """
+        state_dict = torch.load(path, map_location=map_location)
+        state_dict = state_dict.get('state_dict', state_dict)
+        # Lightning checkpoints of SeqMNIST prefix the weights with "model."
+        state_dict = {k.removeprefix('model.'): v for k, v in state_dict.items()}
+
+        n_embd, input_scan_dim = state_dict['encoder.weight'].shape
+        kwargs.setdefault('n_layer', len({k.split('.')[2] for k in state_dict if k.startswith('rwkv.blocks.')}))
+        kwargs.setdefault('tmix', 'x060' if 'rwkv.blocks.0.att.gate.weight' in state_dict else 'x060c')
+        with torch.device('meta') if meta else contextlib.nullcontext():
+            model = cls(input_scan_dim, state_dict['readout.weight'].size(0), n_embd=n_embd, **kwargs)
+        model.load_state_dict(state_dict, assign=True)
+        return model
+
+    def config(self):
+        """Constructor kwargs that rebuild this architecture, RwkvModel(**model.config())"""
+        args = self.gpt_config
+        return {
+            'input_scan_dim': self.input_scan_dim,
+            'output_dim': self.readout.out_features,
+            'n_layer': args.n_layer,
+            'n_embd': args.n_embd,
+            'tmix': args.tmix,
+            'layer_major': self.layer_major,
+            'wkv_mode': args.wkv_mode,
+            'wkv_chunk_size': args.wkv_chunk_size,
+            'wkv_checkpoint_every': args.wkv_checkpoint_every,
+            'skip_blank_prefix': self.skip_blank_prefix,
+            'blank_prefix_granularity': self.blank_prefix_granularity,
+        }
+
+    def weights_hash(self):
+        """sha256 hex digest of the state_dict (names, dtypes, shapes and values)"""
+        h = hashlib.sha256()
+        for name, t in self.state_dict().items():
+            t = t.detach().cpu().contiguous()
+            h.update(f'{name}:{t.dtype}:{tuple(t.shape)};'.encode())
+            h.update(t.view(-1).view(torch.uint8).numpy().tobytes() if t.numel() else b'')
+        return h.hexdigest()
+
+    def _as_scan(self, x):
+        # (B, 1, 28, 28) images, (B, 784) permuted pixels or (B, T, scan) all become (B, T, input_scan_dim)
+        return x.reshape(x.size(0), -1, self.input_scan_dim)
+
     def forward(self, x):
-        batch_size = x.size(0)
-        state = torch.zeros(batch_size, self.gpt_config.n_layer * (2+self.gpt_config.head_size_a), self.gpt_config.n_embd).to(x.device)
-        
-        # print("1", x.shape)
-        for input_t in x.squeeze(1).split(1, dim=1):
+        x = self._as_scan(x)
+        if self.skip_blank_prefix:
+            return self.readout(self._run_blank_prefix(x))
+
+        state = RwkvState.zeros(self.gpt_config, x.size(0), device=x.device)
+        out, state = self._run(x, state)
+        return self.readout(out)
+
+    def resume(self, x, state):
+        """Continues sequences from state (RwkvState or packed), returns the logits and the final state"""
+        if isinstance(state, torch.Tensor):
+            state = RwkvState.from_packed(state, self.gpt_config)
+        out, state = self._run(self._as_scan(x), state)
+        return self.readout(out), state
+
+    def forward_segmented(self, x, window=None, mode='checkpoint'):
+        """
+        Training forward over the sequence in segments of `window` steps
+        (default ceil(sqrt(T))), for long scans such as input_scan_dim=1.
+
+        mode='checkpoint' keeps exact gradients: each segment runs under
+        torch.utils.checkpoint, so backward holds one segment's activations
+        plus the segment boundary states and recomputes the rest.
+        mode='truncated' is truncated BPTT: everything before the last window
+        runs without a graph and gradients only flow through the last window.
+        """
+        x = self._as_scan(x)
+        B, T, _ = x.shape
+        window = window or math.isqrt(T - 1) + 1
+        state = RwkvState.zeros(self.gpt_config, B, device=x.device)
+        if mode == 'truncated':
+            head, tail = x[:, :max(T - window, 0)], x[:, max(T - window, 0):]
+            if head.size(1):
+                with torch.no_grad():
+                    _, state = self._run(head, state)
+                state = state.detach()
+            return self.readout(self._run(tail, state)[0])
+        if mode != 'checkpoint':
+            raise ValueError(f'unknown segmented mode {mode!r}')
+
+        L = self.gpt_config.n_layer
+
+        def segment(seg, *tensors):
+            out, s = self._run(seg, RwkvState(tensors[:L], tensors[L:2*L], tensors[2*L:]))
+            return (out, *s.tensors())
+
+        for seg in x.split(window, dim=1):
+            out, *tensors = torch.utils.checkpoint.checkpoint(segment, seg, *state.tensors(), use_reentrant=False)
+            state = RwkvState(tensors[:L], tensors[L:2*L], tensors[2*L:])
+        return self.readout(out)
+
+    def readout_at(self, x, steps):
+        """Logits after each of the given step indices, (B, len(steps), output_dim), for intermediate losses"""
+        x = self._as_scan(x)
+        state = RwkvState.zeros(self.gpt_config, x.size(0), device=x.device)
+        if self.layer_major:
+            out, _ = self.rwkv(self.encoder(x), state)
+            return self.readout(out[:, steps])
+        outs = []
+        for input_t in x[:, :max(steps) + 1].unbind(1):
+            out, state = self.rwkv(self.encoder(input_t), state)
+            outs.append(out)
+        return self.readout(torch.stack([outs[t] for t in steps], dim=1))
+
+    def forward_early_exit(self, x, threshold=0.9, interval=None, min_steps=None):
+        """
+        Anytime classification: the readout is evaluated every `interval` steps
+        (default T // 7) from min_steps on (default interval), and samples whose
+        top softmax probability reaches threshold stop there. Finished samples
+        are dropped from the batch, so later steps run on fewer rows.
+
+        Returns (logits, steps), steps is the number of scan steps each sample used.
+        """
+        x = self._as_scan(x)
+        B, T, _ = x.shape
+        interval = interval or max(1, T // 7)
+        min_steps = interval if min_steps is None else min_steps
+        state = RwkvState.zeros(self.gpt_config, B, device=x.device)
+        active = torch.arange(B, device=x.device)
+        steps = torch.full((B,), T, device=x.device)
+        logits = None
+        for start in range(0, T, interval):
+            end = min(start + interval, T)
+            out, state = self._run(x[:, start:end], state)
+            y = self.readout(out)
+            if logits is None:
+                logits = y.new_empty(B, y.size(-1))
+            if end == T:
+                logits[active] = y
+                break
+            if end < min_steps:
+                continue
+            done = y.softmax(-1).amax(-1) >= threshold
+            if done.any():
+                logits[active[done]] = y[done]
+                steps[active[done]] = end
+                keep = ~done
+                if not keep.any():
+                    break
+                active, x, state = active[keep], x[keep], state[keep]
+        return logits, steps
+
+    def _run(self, x, state):
+        """Runs (B, T, input_scan_dim) from state, returns the last rwkv output and the final state"""
+        if self.layer_major:
+            out, state = self.rwkv(self.encoder(x), state)
+            return out[:, -1], state
+
+        for input_t in x.split(1, dim=1):
             out = self.encoder(input_t.squeeze(1))
             out, state = self.rwkv(out, state)
-        return self.readout(out)
+        return out, state
+
+    def _blank_states(self, steps, device):
+        """
+        {k: state after k all-zero input rows} at batch size 1 for every k in steps.
+
+        Without gradients the result is cached until any parameter changes,
+        which optimizer steps and load_state_dict detect through the tensors'
+        version counters. With gradients it is recomputed (at batch size 1)
+        on every call so it stays part of the graph.
+        """
+        params = list(self.parameters())
+        cacheable = not (torch.is_grad_enabled() and any(p.requires_grad for p in params))
+        key = (device, tuple((p.data_ptr(), p._version) for p in params))
+        if cacheable and self._blank_cache is not None:
+            cached_key, states = self._blank_cache
+            if cached_key == key and all(k in states for k in steps):
+                return states
+            if cached_key != key:
+                self._blank_cache = None
+
+        states = dict(self._blank_cache[1]) if cacheable and self._blank_cache is not None else {}
+        states.setdefault(0, RwkvState.zeros(self.gpt_config, 1, device=device))
+        # chain segments between consecutive k, each segment runs like any other input
+        for k in sorted(set(steps)):
+            if k in states:
+                continue
+            start = max(j for j in states if j < k)
+            _, states[k] = self._run(torch.zeros(1, k - start, self.input_scan_dim, device=device), states[start])
+        if cacheable:
+            self._blank_cache = (key, states)
+        return states
+
+    def invalidate_blank_cache(self):
+        self._blank_cache = None
+
+    def _run_blank_prefix(self, x):
+        B, T, _ = x.shape
+        granularity = self.blank_prefix_granularity or max(1, T // 8)
+        # length of the leading all-zero run, always leave the last step to run
+        k = (x == 0).all(-1).int().cumprod(1).sum(1).clamp(max=T-1)
+        k = k // granularity * granularity
+        groups = k.unique().tolist()
+        if groups == [0]:
+            return self._run(x, RwkvState.zeros(self.gpt_config, B, device=x.device))[0]
+
+        blank = self._blank_states(groups, x.device)
+        out = None
+        for kb in groups:
+            idx = (k == kb).nonzero().squeeze(1)
+            state = blank[kb]._map(lambda t: t.expand(len(idx), *t.shape[1:]))
+            out_g, _ = self._run(x[idx, kb:], state)
+            if out is None:
+                out = out_g.new_zeros(B, out_g.size(-1))
+            out = out.index_copy(0, idx, out_g)
+        return out
@@ -0,0 +1,123 @@
+"""
+Structured recurrent state for the RWKV stack.
+
+The original code threads a single packed tensor of shape
+(B, n_layer * (2 + S), n_embd) through every sub-layer, where for layer i
+    row (2+S)*i + 0             ffn token-shift input
+    row (2+S)*i + 1             att token-shift input
+    rows (2+S)*i + 2 ... + 2+S  the WKV matrices, reshaped to (H, S, S)
+and every sub-layer clones the whole tensor to change a few rows. RwkvState
+keeps those pieces as separate per-layer tensors instead.
+"""
+
+import torch
+
+
+class RwkvState:
+    """
+    Per-layer att / ffn token-shift buffers (B, C) and WKV matrices (B, H, S, S).
+
+    With inplace=False (the default) the update_* methods return a new container
+    that shares every untouched tensor, nothing is ever written to so it is
+    safe under autograd. With inplace=True they copy into the existing buffers
+    and return self, which avoids any allocation during inference.
+    """
+
+    def __init__(self, att_x, ffn_x, wkv, inplace=False):
+        self.att_x = list(att_x)
+        self.ffn_x = list(ffn_x)
+        self.wkv = list(wkv)
+        self.inplace = inplace
+
+    @staticmethod
+    def _dims(args):
+        S = args.head_size_a
+        return args.n_layer, args.n_embd // S, S
+
+    @classmethod
+    def zeros(cls, args, batch_size, device=None, dtype=torch.float32, inplace=False):
+        L, H, S = cls._dims(args)
+        kw = dict(device=device, dtype=dtype)
+        return cls(
+            [torch.zeros(batch_size, args.n_embd, **kw) for _ in range(L)],
+            [torch.zeros(batch_size, args.n_embd, **kw) for _ in range(L)],
+            [torch.zeros(batch_size, H, S, S, **kw) for _ in range(L)],
+            inplace=inplace,
+        )
+
+    @classmethod
+    def from_packed(cls, packed, args, inplace=False):
+        L, H, S = cls._dims(args)
+        B = packed.size(0)
+        return cls(
+            [packed[:, (2+S)*i+1] for i in range(L)],
+            [packed[:, (2+S)*i+0] for i in range(L)],
+            [packed[:, (2+S)*i+2:(2+S)*(i+1)].reshape(B, H, S, S) for i in range(L)],
+            inplace=inplace,
+        )
+
+    def to_packed(self):
+        B = self.batch_size
+        rows = []
+        for att_x, ffn_x, wkv in zip(self.att_x, self.ffn_x, self.wkv):
+            rows += [ffn_x.unsqueeze(1), att_x.unsqueeze(1), wkv.reshape(B, wkv.size(-1), -1)]
+        return torch.cat(rows, dim=1)
+
+    @property
+    def n_layer(self):
+        return len(self.wkv)
+
+    @property
+    def batch_size(self):
+        return self.wkv[0].size(0)
+
+    def tensors(self):
+        return self.att_x + self.ffn_x + self.wkv
+
+    def _map(self, fn):
+        L = self.n_layer
+        t = [fn(x) for x in self.tensors()]
+        return RwkvState(t[:L], t[L:2*L], t[2*L:], inplace=self.inplace)
+
+    def update_att(self, layer_id, x, wkv):
+        if self.inplace:
+            self.att_x[layer_id].copy_(x)
+            self.wkv[layer_id].copy_(wkv)
+            return self
+        new = RwkvState(self.att_x, self.ffn_x, self.wkv)
+        new.att_x[layer_id] = x
+        new.wkv[layer_id] = wkv
+        return new
+
+    def update_ffn(self, layer_id, x):
+        if self.inplace:
+            self.ffn_x[layer_id].copy_(x)
+            return self
+        new = RwkvState(self.att_x, self.ffn_x, self.wkv)
+        new.ffn_x[layer_id] = x
+        return new
+
+    def reset(self, index=None):
+        """Zero the whole state, or only the given batch rows, in place"""
+        for x in self.tensors():
+            if index is None:
+                x.zero_()
+            else:
+                x[index] = 0
+        return self
+
+    def __getitem__(self, index):
+        return self._map(lambda x: x[index])
+
+    def __setitem__(self, index, other):
+        for x, y in zip(self.tensors(), other.tensors()):
+            x[index] = y
+
+    def clone(self):
+        return self._map(torch.clone)
+
+    def detach(self):
+        return self._map(torch.Tensor.detach)
+
+    def to(self, *args, **kwargs):
+        return self._map(lambda x: x.to(*args, **kwargs))
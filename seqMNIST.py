@@ -2,17 +2,85 @@
 # https://github.com/williamFalcon/pytorch-lightning#how-do-i-do-use-it
 
 import os
+import warnings
 import torch
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
-from torchvision.datasets import MNIST
-import torchvision.transforms as transforms
 import pytorch_lightning as pl
 
+from mnist_data import TensorBatchLoader, load_mnist, split_indices
+from profiling import hotpath
+
+
+class HotPathCallback(pl.Callback):
+    """
+    Enables the hot-path profiler during training and logs, per epoch, the
+    total time of every region plus a histogram of its per-call durations.
+    With trace_dir set, also writes a torch.profiler Chrome trace covering
+    trace_steps training steps starting at global step trace_start.
+    """
+
+    def __init__(self, trace_dir=None, trace_start=10, trace_steps=5):
+        self.trace_dir = trace_dir
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self._prof = None
+        self._traced = False
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        hotpath.reset()
+        hotpath.enable()
+
+    def on_validation_start(self, trainer, pl_module):
+        hotpath.disable()
+
+    def on_validation_end(self, trainer, pl_module):
+        if trainer.training:
+            hotpath.enable()
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        # global_step counts optimizer steps, with gradient accumulation several
+        # micro batches share one, so the window spans trace_steps optimizer steps
+        if self.trace_dir and self._prof is None and not self._traced and trainer.global_step == self.trace_start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._prof = torch.profiler.profile(activities=activities)
+            self._prof.__enter__()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        if self._prof is not None and trainer.global_step >= self.trace_start + self.trace_steps:
+            self._stop_trace()
+
+    def _stop_trace(self):
+        self._prof.__exit__(None, None, None)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        self._prof.export_chrome_trace(os.path.join(self.trace_dir, f'trace_step{self.trace_start}.json'))
+        self._prof = None
+        self._traced = True
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        samples = hotpath.reset()
+        experiment = getattr(trainer.logger, 'experiment', None)
+        for name, durations in sorted(samples.items()):
+            ms = torch.tensor(durations) * 1e3
+            pl_module.log(f'hotpath/{name}_ms', ms.sum().item())
+            if hasattr(experiment, 'add_histogram'):
+                experiment.add_histogram(f'hotpath/{name}', ms, trainer.current_epoch)
+
+    def on_train_end(self, trainer, pl_module):
+        hotpath.disable()
+        if self._prof is not None:
+            self._stop_trace()
+        elif self.trace_dir and not self._traced:
+            warnings.warn(f'training ended at global step {trainer.global_step} before trace_start={self.trace_start}, '
+                          f'no trace written to {self.trace_dir}')
+
 
 class SeqMNIST(pl.LightningModule):
 
-    def __init__(self, model, learning_rate, default_batch_size, is_permuted, percent_validation=0.25):
+    def __init__(self, model, learning_rate, default_batch_size, is_permuted, percent_validation=0.25, data_seed=0, data_root=None,
+                 profile_hotpath=False, trace_dir=None, trace_start=10, trace_steps=5, bptt='full', bptt_window=None,
+                 exit_loss_interval=None, exit_loss_weight=1.0):
         super(SeqMNIST, self).__init__()
         self.mnist_dim = 28 * 28
         self.model = model
@@ -21,32 +89,84 @@ class SeqMNIST(pl.LightningModule):
         self.fixed_permutation = None
         if is_permuted:
             print('Running permuted version')
-            self.fixed_permutation = torch.randperm(self.mnist_dim)
+            # seeded, so every DDP process (and a reloaded checkpoint) sees the same permutation
+            self.fixed_permutation = torch.randperm(self.mnist_dim, generator=torch.Generator().manual_seed(data_seed))
 
-        # splitting datasets here so training and validation do not overlap
-        full_train_dataset = MNIST(os.getcwd(), train=True, download=True, transform=transforms.ToTensor())
+        # 'full' backpropagates through the whole scan, 'checkpoint' and
+        # 'truncated' train in segments of bptt_window steps, see
+        # RwkvModel.forward_segmented
+        assert bptt in ('full', 'checkpoint', 'truncated')
+        self.bptt = bptt
+        self.bptt_window = bptt_window
+        # with exit_loss_interval set, the readout after every that many steps
+        # is trained too (mean loss scaled by exit_loss_weight), so
+        # RwkvModel.forward_early_exit can stop on confident early readouts
+        assert exit_loss_interval is None or bptt == 'full'
+        self.exit_loss_interval = exit_loss_interval
+        self.exit_loss_weight = exit_loss_weight
+
+        self.data_seed = data_seed
+        self.profile_hotpath = profile_hotpath
+        self.trace_dir = trace_dir
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+
+        # datasets are only touched in prepare_data / setup, so constructing
+        # the module for inference never needs MNIST on disk
         assert 0 <= percent_validation < 1
-        val_nb = round(len(full_train_dataset) * percent_validation)
-        tng_nb = len(full_train_dataset) - val_nb
-        self.train_dataset, self.val_dataset = torch.utils.data.random_split(full_train_dataset, [tng_nb, val_nb])
-        self.test_dataset = MNIST(os.getcwd(), train=False, download=True, transform=transforms.ToTensor())
-        assert len(self.train_dataset) + len(self.val_dataset) == len(full_train_dataset)
-        print(f'training samples:   {tng_nb:>7}')
-        print(f'validation samples: {val_nb:>7}')
-        print(f'test samples:       {len(self.test_dataset):>7}')
+        self.percent_validation = percent_validation
+        self.data_root = data_root or os.getcwd()
+        self.train_dataset = None
+        self.val_dataset = None
+        self.test_dataset = None
+
+    def prepare_data(self):
+        # download and decode once per node, setup() memory-maps the cache
+        load_mnist(self.data_root, train=True)
+        load_mnist(self.data_root, train=False)
+
+    def setup(self, stage=None):
+        if self.train_dataset is not None:
+            return
+        # splitting datasets here so training and validation do not overlap,
+        # the split is seeded so every run sees the same validation set
+        images, labels = load_mnist(self.data_root, train=True)
+        tng_idx, val_idx = split_indices(len(labels), self.percent_validation, seed=self.data_seed)
+        self.train_dataset = (images[tng_idx], labels[tng_idx])
+        self.val_dataset = (images[val_idx], labels[val_idx])
+        self.test_dataset = load_mnist(self.data_root, train=False)
+        print(f'training samples:   {len(tng_idx):>7}')
+        print(f'validation samples: {len(val_idx):>7}')
+        print(f'test samples:       {len(self.test_dataset[1]):>7}')
         print('')
 
-    def forward(self, x):
+    def _scan(self, x):
         if self.fixed_permutation is not None:
-            permuted_x = x.view(-1, self.mnist_dim)[:, self.fixed_permutation]
-            return self.model(permuted_x)
-        else:
-            return self.model(x)
+            return x.reshape(-1, self.mnist_dim)[:, self.fixed_permutation]
+        return x
+
+    def forward(self, x):
+        return self.model(self._scan(x))
 
     def training_step(self, batch, batch_nb):
         x, y = batch
-        y_hat = self.forward(x)
+        exit_loss = None
+        if self.exit_loss_interval:
+            T = self.mnist_dim // self.model.input_scan_dim
+            steps = list(range(self.exit_loss_interval - 1, T - 1, self.exit_loss_interval)) + [T - 1]
+            y_all = self.model.readout_at(self._scan(x), steps)
+            y_hat = y_all[:, -1]
+            if len(steps) > 1:
+                early = y_all[:, :-1]
+                exit_loss = F.cross_entropy(early.flatten(0, 1), y.repeat_interleave(early.size(1)))
+        elif self.bptt == 'full':
+            y_hat = self.forward(x)
+        else:
+            y_hat = self.model.forward_segmented(self._scan(x), self.bptt_window, self.bptt)
         loss = F.cross_entropy(y_hat, y)
+        if exit_loss is not None:
+            self.log("exit_loss", exit_loss)
+            loss = loss + self.exit_loss_weight * exit_loss
         accuracy = (y_hat.argmax(1) == y).float().mean()
         self.log("loss", loss, prog_bar=True)
         self.log("train_accuracy", accuracy, prog_bar=True)
@@ -57,8 +177,8 @@ class SeqMNIST(pl.LightningModule):
         y_hat = self.forward(x)
         loss = F.cross_entropy(y_hat, y)
         accuracy = (y_hat.argmax(1) == y).float().mean()
-        self.log("val_loss", loss, prog_bar=True)
-        self.log("val_accuracy", accuracy, prog_bar=True)
+        self.log("val_loss", loss, prog_bar=True, sync_dist=True)
+        self.log("val_accuracy", accuracy, prog_bar=True, sync_dist=True)
         return loss
 
     def test_step(self, batch, batch_nb):
@@ -66,18 +186,30 @@ class SeqMNIST(pl.LightningModule):
         y_hat = self.forward(x)
         loss = F.cross_entropy(y_hat, y)
         accuracy = (y_hat.argmax(1) == y).float().mean()
-        self.log("test_loss", loss, prog_bar=True)
-        self.log("test_accuracy", accuracy, prog_bar=True)
+        self.log("test_loss", loss, prog_bar=True, sync_dist=True)
+        self.log("test_accuracy", accuracy, prog_bar=True, sync_dist=True)
         return loss
 
+    def configure_callbacks(self):
+        if self.profile_hotpath or self.trace_dir:
+            return [HotPathCallback(trace_dir=self.trace_dir, trace_start=self.trace_start, trace_steps=self.trace_steps)]
+        return []
+
     def configure_optimizers(self):
         return torch.optim.Adam(self.parameters(), lr=self.learning_rate)
 
+    def _shard(self):
+        # one shard per DDP process, TensorBatchLoader isn't a DataLoader so
+        # Lightning can't inject a DistributedSampler itself
+        if self._trainer is None or self._trainer.world_size == 1:
+            return {}
+        return dict(num_replicas=self._trainer.world_size, rank=self._trainer.global_rank)
+
     def train_dataloader(self):
-        return DataLoader(self.train_dataset, batch_size=self.default_batch_size, num_workers=8)
+        return TensorBatchLoader(*self.train_dataset, batch_size=self.default_batch_size, shuffle=True, seed=self.data_seed, **self._shard())
 
     def val_dataloader(self):
-        return DataLoader(self.val_dataset, batch_size=self.default_batch_size, num_workers=8)
+        return TensorBatchLoader(*self.val_dataset, batch_size=self.default_batch_size, **self._shard())
 
     def test_dataloader(self):
-        return DataLoader(self.test_dataset, batch_size=self.default_batch_size, num_workers=8)
+        return TensorBatchLoader(*self.test_dataset, batch_size=self.default_batch_size, **self._shard())
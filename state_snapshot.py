@@ -0,0 +1,225 @@
+"""
+On-disk snapshots of the recurrent state of many sessions.
+
+File layout, little-endian:
+
+    b'RWKVSNAP' | uint32 version | uint32 header bytes | JSON header | zero pad to 4096
+    layer 0 section: (N, 2 + S, C) rows ffn_x, att_x, wkv (S rows), same as the packed state
+    layer 1 section ...
+
+The JSON header records the model config (RwkvModel.config()), weights_hash(),
+dtype, dimensions and optional session ids. Every section is one contiguous
+block, so load() memory-maps the file and hands out RwkvState views of it
+without copying, and save() is one write per layer regardless of how many
+sessions it holds.
+
+    state_snapshot.save('sessions.snap', state, model, session_ids=ids)
+    snap = state_snapshot.load('sessions.snap', model)   # checks architecture and weights
+    logits, state = model.resume(x, snap.gather([3, 17, 17]))
+"""
+
+import json
+import os
+import struct
+import types
+import warnings
+
+import numpy as np
+import torch
+
+from rwkv_state import RwkvState
+
+MAGIC = b'RWKVSNAP'
+VERSION = 1
+ALIGN = 4096
+_PREFIX = struct.Struct('<8sII')
+# config fields that determine the state layout and meaning
+ARCHITECTURE = ('input_scan_dim', 'output_dim', 'n_layer', 'n_embd', 'tmix')
+
+
+def _as_state(state, head_size):
+    if isinstance(state, RwkvState):
+        return state
+    L_rows, C = state.shape[1:]
+    args = types.SimpleNamespace(head_size_a=head_size, n_layer=L_rows // (2 + head_size), n_embd=C)
+    return RwkvState.from_packed(state, args)
+
+
+def save(path, state, model=None, config=None, weights_hash=None, session_ids=None, head_size=64):
+    """
+    Writes an RwkvState or packed (B, n_layer * (2 + S), C) state. The config
+    and weights hash are taken from model unless given; the file is replaced
+    atomically.
+    """
+    state = _as_state(state, head_size)
+    if model is not None:
+        config = config or model.config()
+        weights_hash = weights_hash or model.weights_hash()
+    N, L = state.batch_size, state.n_layer
+    H, S = state.wkv[0].shape[1:3]
+    C = H * S
+    dtype = state.wkv[0].dtype
+    if session_ids is not None:
+        session_ids = [str(i) for i in session_ids]
+        if len(session_ids) != N:
+            raise ValueError(f'{len(session_ids)} session ids for {N} sessions')
+    header = json.dumps({
+        'config': config, 'weights_hash': weights_hash, 'dtype': str(dtype).removeprefix('torch.'),
+        'n_sessions': N, 'n_layer': L, 'n_embd': C, 'head_size': S, 'session_ids': session_ids,
+    }).encode()
+    data_offset = -(-(_PREFIX.size + len(header)) // ALIGN) * ALIGN
+
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        f.write(bytes(data_offset - f.tell()))
+        for i in range(L):
+            section = torch.cat((state.ffn_x[i].unsqueeze(1), state.att_x[i].unsqueeze(1),
+                                 state.wkv[i].reshape(N, S, C)), dim=1)
+            f.write(section.detach().cpu().contiguous().numpy().data)
+    os.replace(tmp, path)
+
+
+class Snapshot:
+    """
+    A memory-mapped snapshot file. .state() is a zero-copy RwkvState over
+    the whole file, .gather(index) copies the selected sessions out, and with
+    writable=True snap[index] = state writes sessions back in place.
+    """
+
+    def __init__(self, path, writable=False):
+        with open(path, 'rb') as f:
+            magic, version, size = _PREFIX.unpack(f.read(_PREFIX.size))
+            if magic != MAGIC:
+                raise ValueError(f'{path} is not a state snapshot')
+            if version != VERSION:
+                raise ValueError(f'{path} has snapshot version {version}, this reader supports {VERSION}')
+            self.header = json.loads(f.read(size))
+        h = self.header
+        self.path = path
+        self.config = h['config']
+        self.weights_hash = h['weights_hash']
+        self.session_ids = h['session_ids']
+        N, L, C, S = h['n_sessions'], h['n_layer'], h['n_embd'], h['head_size']
+        offset = -(-(_PREFIX.size + size) // ALIGN) * ALIGN
+        self._data = np.memmap(path, dtype=np.dtype(h['dtype']), mode='r+' if writable else 'r',
+                               offset=offset, shape=(L, N, 2 + S, C))
+
+    def __len__(self):
+        return self.header['n_sessions']
+
+    def check(self, model):
+        """
+        Raises ValueError if the snapshot was taken with a different architecture
+        or weights. Runtime settings (layer_major, wkv_mode, blank prefix
+        skipping, ...) don't change the state, so any of them may differ.
+        """
+        config = model.config()
+        saved = {k: (self.config or {}).get(k) for k in ARCHITECTURE}
+        current = {k: config[k] for k in ARCHITECTURE}
+        if saved != current or self.header['head_size'] != model.gpt_config.head_size_a:
+            raise ValueError(f'{self.path} was saved for {saved} with head size {self.header["head_size"]}, '
+                             f'model has {current} with head size {model.gpt_config.head_size_a}')
+        if self.weights_hash is not None and self.weights_hash != model.weights_hash():
+            raise ValueError(f'{self.path} was saved with different weights')
+
+    def index_of(self, session_ids):
+        lookup = {s: i for i, s in enumerate(self.session_ids or ())}
+        return [lookup[str(s)] for s in session_ids]
+
+    def _state(self, sections, inplace=False):
+        # (L, N, 2 + S, C) -> per-layer views
+        N, S = sections.shape[1], self.header['head_size']
+        H = self.header['n_embd'] // S
+        return RwkvState([sections[i, :, 1] for i in range(len(sections))],
+                         [sections[i, :, 0] for i in range(len(sections))],
+                         [sections[i, :, 2:].reshape(N, H, S, S) for i in range(len(sections))],
+                         inplace=inplace)
+
+    def state(self):
+        """RwkvState viewing the mapped file, no copy; read only unless opened writable"""
+        with warnings.catch_warnings():
+            # torch warns about read-only numpy buffers, the views are never written unless writable
+            warnings.simplefilter('ignore', UserWarning)
+            return self._state(torch.from_numpy(self._data))
+
+    def gather(self, index=None, device=None):
+        """
+        Fresh RwkvState of the sessions at index (ints, a slice, or None for all),
+        repeats allowed, e.g. gather([0] * B) warm-starts B sequences from one state.
+        """
+        index = slice(None) if index is None else index
+        sections = torch.from_numpy(np.array(self._data[:, index]))
+        return self._state(sections).to(device) if device is not None else self._state(sections)
+
+    def gather_packed(self, index=None, device=None):
+        """Like gather() but as the legacy packed (B, n_layer * (2 + S), C) tensor"""
+        index = slice(None) if index is None else index
+        sections = torch.from_numpy(np.ascontiguousarray(self._data[:, index].swapaxes(0, 1)))
+        packed = sections.reshape(sections.size(0), -1, sections.size(-1))
+        return packed.to(device) if device is not None else packed
+
+    def __setitem__(self, index, state):
+        if not self._data.flags.writeable:
+            raise ValueError(f'{self.path} was opened read only, use load(..., writable=True)')
+        self._state(torch.from_numpy(self._data), inplace=True)[index] = state
+        self._data.flush()
+
+
+def load(path, model=None, writable=False):
+    """Opens a snapshot, checking it against model when given"""
+    snap = Snapshot(path, writable=writable)
+    if model is not None:
+        snap.check(model)
+    return snap
+
+
+def gather(snapshots, indices=None, device=None):
+    """Concatenates sessions from several snapshots into one RwkvState batch"""
+    indices = indices or [None] * len(snapshots)
+    parts = [snap.gather(index) for snap, index in zip(snapshots, indices)]
+    L = parts[0].n_layer
+    t = [torch.cat(ts) for ts in zip(*(p.tensors() for p in parts))]
+    state = RwkvState(t[:L], t[L:2*L], t[2*L:])
+    return state.to(device) if device is not None else state
+
+
+if __name__ == '__main__':
+    import tempfile
+    import time
+
+    from rwkv_model import RwkvModel
+
+    torch.manual_seed(0)
+    model = RwkvModel(28, 10, skip_blank_prefix=False).eval()
+    N = 2048
+    x = torch.rand(N, 28, 28)
+    with torch.inference_mode():
+        _, state = model.resume(x[:, :14], RwkvState.zeros(model.gpt_config, N))
+        full, _ = model.resume(x, RwkvState.zeros(model.gpt_config, N))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'sessions.snap')
+        start = time.perf_counter()
+        save(path, state, model, session_ids=range(N))
+        saved = time.perf_counter() - start
+        start = time.perf_counter()
+        snap = load(path, model)
+        view = snap.state()
+        loaded = time.perf_counter() - start
+        pickled = os.path.join(tmp, 'pickles')
+        os.makedirs(pickled)
+        start = time.perf_counter()
+        for i in range(N):
+            torch.save([t[i].clone() for t in state.tensors()], os.path.join(pickled, f'{i}.pt'))
+        per_session = time.perf_counter() - start
+
+        idx = snap.index_of([5, 1000, 5])
+        with torch.inference_mode():
+            resumed, _ = model.resume(x[idx, 14:], snap.gather(idx))
+        print(f'{N} sessions, {os.path.getsize(path) / 2**20:.1f} MiB: save {saved * 1e3:.1f} ms, '
+              f'load (mmap) {loaded * 1e3:.2f} ms, per-session torch.save {per_session * 1e3:.0f} ms')
+        print(f'zero copy: {view.wkv[0].data_ptr() == torch.from_numpy(snap._data).data_ptr() + 2 * 64 * 4}, '
+              f'resumed max abs diff {(resumed - full[idx]).abs().max().item():.2e}, '
+              f'packed matches {torch.equal(snap.gather_packed(idx), snap.gather(idx).to_packed())}')
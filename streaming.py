@@ -0,0 +1,293 @@
+"""
+Streaming inference with continuous batching of sessions.
+
+Each session owns a slot in a preallocated RwkvState pool. Clients feed scan
+rows as they arrive and get the current readout logits back; the scheduler
+coalesces the next pending row of every ready session into one batched
+RWKV step, waiting at most max_wait_ms for more sessions to join a batch.
+
+    python streaming.py --port 8765                      # JSON-lines socket server
+    python streaming.py --bench-clients 64 --bench-rows 28
+
+Protocol, one JSON object per line:
+    {"op": "create"}                              -> {"session": 3}
+    {"op": "feed", "session": 3, "rows": [[...]]} -> {"logits": [...], "steps": 5}
+    {"op": "close", "session": 3}                 -> {"ok": true}
+    {"op": "stats"}                               -> {"p50_ms": ..., "p99_ms": ..., "steps_per_s": ...}
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from rwkv_model import RwkvModel
+from rwkv_state import RwkvState
+
+
+class SlotPool:
+    """Fixed-capacity pool of per-session recurrent states"""
+
+    def __init__(self, args, capacity, device=None):
+        self.state = RwkvState.zeros(args, capacity, device=device, inplace=True)
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def allocate(self):
+        if not self.free:
+            raise RuntimeError('no free session slots')
+        slot = self.free.pop()
+        self.state.reset(slot)
+        return slot
+
+    def release(self, slot):
+        self.free.append(slot)
+
+
+class StreamingEngine:
+    """Runs one batched RWKV step for an arbitrary set of pool slots"""
+
+    def __init__(self, model, capacity):
+        self.model = model.eval()
+        device = next(model.parameters()).device
+        self.pool = SlotPool(model.gpt_config, capacity, device=device)
+
+    @torch.inference_mode()
+    def step(self, slots, rows):
+        idx = torch.tensor(slots, device=rows.device)
+        out, state = self.model.rwkv(self.model.encoder(rows), self.pool.state[idx])
+        self.pool.state[idx] = state
+        return self.model.readout(out)
+
+
+class Session:
+    def __init__(self, slot):
+        self.slot = slot
+        self.rows = collections.deque()
+        self.waiters = []
+        self.enqueued = 0
+        self.steps = 0
+        self.logits = None
+
+
+class StreamingScheduler:
+
+    def __init__(self, engine, max_batch=64, max_wait_ms=2.0):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1e3
+        self.sessions = collections.OrderedDict()
+        self.latencies = collections.deque(maxlen=100000)
+        self.steps = 0
+        self.batches = 0
+        self.started = time.perf_counter()
+        self._next_id = 0
+        self._inflight = set()
+        self._deferred = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.error = None
+        # a single worker keeps steps ordered and the event loop responsive
+        self._executor = ThreadPoolExecutor(1)
+
+    def create_session(self):
+        sid = self._next_id
+        self._next_id += 1
+        self.sessions[sid] = Session(self.engine.pool.allocate())
+        return sid
+
+    def close_session(self, sid):
+        session = self.sessions.pop(sid)
+        # a step in flight still writes this slot back, recycle it afterwards
+        if session.slot in self._inflight:
+            self._deferred.append(session.slot)
+        else:
+            self.engine.pool.release(session.slot)
+        for _, fut, _ in session.waiters:
+            fut.cancel()
+
+    async def feed(self, sid, rows):
+        """Queue one or more scan rows, resolves to the logits after the last of them"""
+        if self.error is not None:
+            raise RuntimeError('scheduler stopped') from self.error
+        session = self.sessions[sid]
+        rows = torch.as_tensor(rows, dtype=torch.float32).view(-1, self.engine.model.input_scan_dim)
+        session.rows.extend(rows.unbind(0))
+        session.enqueued += len(rows)
+        fut = asyncio.get_running_loop().create_future()
+        session.waiters.append((session.enqueued, fut, time.perf_counter()))
+        self._wakeup.set()
+        return await fut
+
+    def start(self):
+        """Runs the step loop as a task; if it dies, every pending and later feed fails instead of hanging"""
+        self._task = asyncio.create_task(self.run())
+        self._task.add_done_callback(self._stopped)
+        return self._task
+
+    def _stopped(self, task):
+        if task.cancelled():
+            return
+        self.error = task.exception() or RuntimeError('scheduler loop exited')
+        traceback.print_exception(self.error)
+        for session in self.sessions.values():
+            for _, fut, _ in session.waiters:
+                if not fut.done():
+                    fut.set_exception(self.error)
+            session.waiters.clear()
+
+    def _ready(self):
+        return [sid for sid, s in self.sessions.items() if s.rows]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            ready = self._ready()
+            if not ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            deadline = loop.time() + self.max_wait
+            while len(ready) < self.max_batch and loop.time() < deadline:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    pass
+                ready = self._ready()
+
+            batch = ready[:self.max_batch]
+            sessions = [self.sessions[sid] for sid in batch]
+            rows = torch.stack([s.rows.popleft() for s in sessions])
+            slots = [s.slot for s in sessions]
+            self._inflight.update(slots)
+            logits = await loop.run_in_executor(self._executor, self.engine.step, slots, rows)
+            self._inflight.clear()
+            while self._deferred:
+                self.engine.pool.release(self._deferred.pop())
+
+            now = time.perf_counter()
+            for sid, session, row_logits in zip(batch, sessions, logits):
+                session.steps += 1
+                session.logits = row_logits
+                while session.waiters and session.waiters[0][0] <= session.steps:
+                    _, fut, t0 = session.waiters.pop(0)
+                    if not fut.done():
+                        fut.set_result(row_logits.tolist())
+                    self.latencies.append(now - t0)
+                # round-robin so no session starves behind a full batch
+                if sid in self.sessions:
+                    self.sessions.move_to_end(sid)
+            self.steps += len(batch)
+            self.batches += 1
+
+    def stats(self):
+        lat = sorted(self.latencies)
+
+        def pct(q):
+            return lat[min(len(lat) - 1, int(q * len(lat)))] * 1e3 if lat else None
+
+        elapsed = time.perf_counter() - self.started
+        return {
+            'p50_ms': pct(0.50),
+            'p99_ms': pct(0.99),
+            'steps_per_s': self.steps / elapsed,
+            'mean_batch': self.steps / max(self.batches, 1),
+            'sessions': len(self.sessions),
+        }
+
+
+async def handle_client(scheduler, reader, writer):
+    # sessions belong to the connection that created them and close with it
+    owned = set()
+    try:
+        while line := await reader.readline():
+            try:
+                req = json.loads(line)
+                op = req['op']
+                if op == 'create':
+                    sid = scheduler.create_session()
+                    owned.add(sid)
+                    resp = {'session': sid}
+                elif op == 'feed':
+                    logits = await scheduler.feed(req['session'], req['rows'])
+                    resp = {'logits': logits, 'steps': scheduler.sessions[req['session']].steps}
+                elif op == 'close':
+                    scheduler.close_session(req['session'])
+                    owned.discard(req['session'])
+                    resp = {'ok': True}
+                elif op == 'stats':
+                    resp = scheduler.stats()
+                else:
+                    resp = {'error': f'unknown op {op!r}'}
+            except Exception as e:
+                resp = {'error': repr(e)}
+            writer.write((json.dumps(resp) + '\n').encode())
+            await writer.drain()
+    finally:
+        for sid in owned:
+            if sid in scheduler.sessions:
+                scheduler.close_session(sid)
+        writer.close()
+
+
+async def bench(scheduler, clients, rows_per_client):
+    """In-process synthetic clients, each streams one sequence row by row"""
+    dim = scheduler.engine.model.input_scan_dim
+
+    async def client():
+        sid = scheduler.create_session()
+        for row in torch.rand(rows_per_client, dim):
+            await scheduler.feed(sid, row)
+        scheduler.close_session(sid)
+
+    runner = scheduler.start()
+    scheduler.started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    runner.cancel()
+    return scheduler.stats()
+
+
+def load_model(checkpoint, input_scan_dim, output_dim):
+    if checkpoint:
+        return RwkvModel.from_checkpoint(checkpoint)
+    return RwkvModel(input_scan_dim, output_dim)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checkpoint', default=None, help='SeqMNIST/RwkvModel checkpoint, random weights if omitted')
+    parser.add_argument('--input-scan-dim', type=int, default=28)
+    parser.add_argument('--output-dim', type=int, default=10)
+    parser.add_argument('--capacity', type=int, default=1024, help='maximum number of open sessions')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--bench-clients', type=int, default=0, help='run synthetic clients instead of serving')
+    parser.add_argument('--bench-rows', type=int, default=28)
+    args = parser.parse_args()
+
+    engine = StreamingEngine(load_model(args.checkpoint, args.input_scan_dim, args.output_dim), args.capacity)
+
+    async def serve():
+        scheduler = StreamingScheduler(engine, args.max_batch, args.max_wait_ms)
+        if args.bench_clients:
+            print(json.dumps(await bench(scheduler, args.bench_clients, args.bench_rows), indent=2))
+            return
+        scheduler.start()
+        server = await asyncio.start_server(lambda r, w: handle_client(scheduler, r, w), args.host, args.port)
+        print(f'serving on {args.host}:{args.port}')
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+WKV kernels shared by the RWKV time-mix layers.
+
+All kernels take per-head tensors laid out as (B, T, H, S):
+    r, k, v : receptance / key / value
+    w       : per-channel decay in (0, 1]
+    u       : time_faaaa bonus, (H, S, 1)
+    s       : initial state, (B, H, S, S) indexed [key, value]
+and return (y, s) where y is (B, T, H, S) and s the state after the last step.
+"""
+
+import torch
+
+
+def wkv_recurrent(r, k, v, w, u, s):
+    """Reference step-by-step recurrence, identical to the per-timestep layers."""
+    B, T, H, S = r.shape
+    r = r.unsqueeze(-2)
+    k = k.unsqueeze(-1)
+    v = v.unsqueeze(-2)
+    w = w.unsqueeze(-1)
+
+    out = []
+    for t in range(T):
+        a = k[:, t] @ v[:, t]
+        out.append(r[:, t] @ (u * a + s))
+        s = a + w[:, t] * s
+    return torch.stack(out, dim=1).view(B, T, H, S), s
+
+
+def _segsum(lw):
+    """seg[..., t, j, :] = sum of lw[..., i, :] for j < i <= t, -inf above the diagonal"""
+    C = lw.size(-2)
+    x = lw.unsqueeze(-2).expand(*lw.shape[:-1], C, lw.size(-1))
+    lower = torch.ones(C, C, dtype=torch.bool, device=lw.device).tril(-1)
+    x = x.masked_fill(~lower.unsqueeze(-1), 0).cumsum(-3)
+    full = torch.ones(C, C, dtype=torch.bool, device=lw.device).tril()
+    return x.masked_fill(~full.unsqueeze(-1), float('-inf'))
+
+
+def _wkv_chunk_safe(r, k, v, lw, u, s):
+    """One chunk (B, H, C, S) using pairwise segment sums, never exponentiates a positive number"""
+    C = r.size(-2)
+    seg = _segsum(lw)
+    # decay seen by key j from query t is the product of w over j < i < t
+    d = torch.cat((torch.full_like(seg[..., :1, :, :], float('-inf')), seg[..., :-1, :, :]), dim=-3)
+    att = torch.einsum('bhtd,bhjd,bhtjd->bhtj', r, k, d.exp())
+    y = att @ v + (r * u * k).sum(-1, keepdim=True) * v
+
+    a_ex = torch.cat((torch.zeros_like(lw[..., :1, :]), lw[..., :-1, :].cumsum(-2)), dim=-2)
+    y = y + (r * a_ex.exp()) @ s
+    s = lw.sum(-2).exp().unsqueeze(-1) * s + (k * seg[..., C-1, :, :].exp()).transpose(-1, -2) @ v
+    return y, s
+
+
+def wkv_chunked(r, k, v, w, u, s, chunk_size=16, log_limit=60.0, safe=None):
+    """
+    Chunked-parallel form of the recurrence.
+
+    Inside a chunk of length C the contributions are batched matmuls over
+    cumulative log-decays, only the state crosses chunk boundaries, so T steps
+    cost ceil(T / C) sequential iterations. When a chunk decays by more than
+    exp(-log_limit) the factorised form could overflow, and the whole call falls
+    back to exact pairwise segment sums computed chunk by chunk. safe=True or
+    False forces either form and skips that data-dependent check (for vmap);
+    safe=False instead clamps every step's log-decay to -log_limit / C so a
+    chunk can't decay past the limit, which only changes decays that leave
+    less than exp(-log_limit / C) of the state anyway.
+    """
+    B, T, H, S = r.shape
+    C = chunk_size
+    N = -(-T // C)
+    pad = N * C - T
+
+    lw = w.clamp_min(torch.finfo(w.dtype).tiny).log()
+    if safe is False:
+        lw = lw.clamp_min(-log_limit / C)
+    u = u.view(1, H, 1, 1, S)
+
+    def chunks(x):
+        x = torch.nn.functional.pad(x, (0, 0, 0, 0, 0, pad))
+        return x.transpose(1, 2).reshape(B, H, N, C, S)
+
+    r, k, v, lw = chunks(r), chunks(k), chunks(v), chunks(lw)
+    a = lw.cumsum(-2)
+
+    if safe is None:
+        safe = N > 0 and bool(a[..., -1, :].min() <= -log_limit)
+    if safe:
+        out = []
+        for n in range(N):
+            y, s = _wkv_chunk_safe(r[:, :, n], k[:, :, n], v[:, :, n], lw[:, :, n], u[:, :, 0], s)
+            out.append(y)
+        y = torch.stack(out, dim=2)
+    else:
+        q = r * (a - lw).exp()
+        att = (q @ (k * (-a).exp()).transpose(-1, -2)).tril(-1)
+        y = att @ v + (r * u * k).sum(-1, keepdim=True) * v
+
+        a_last = a[..., -1:, :]
+        kv = (k * (a_last - a).exp()).transpose(-1, -2) @ v
+        decay = a_last.exp().transpose(-1, -2)
+        states = []
+        for n in range(N):
+            states.append(s)
+            s = decay[:, :, n] * s + kv[:, :, n]
+        y = y + q @ torch.stack(states, dim=2)
+
+    y = y.reshape(B, H, N * C, S)[:, :, :T].transpose(1, 2)
+    return y, s
+
+
+class WKVFunction(torch.autograd.Function):
+    """
+    The recurrence with a hand-written backward.
+
+    Autograd through wkv_recurrent keeps several (B, H, S, S) tensors alive per
+    step. Here forward only keeps the state at every checkpoint_every-th step,
+    backward recomputes the states of one segment at a time from its checkpoint
+    and walks the recursion in reverse.
+    """
+
+    @staticmethod
+    def _step(r, k, v, w, u, s):
+        y = (r * u * k).sum(-1, keepdim=True) * v + torch.einsum('bhi,bhij->bhj', r, s)
+        s = k.unsqueeze(-1) * v.unsqueeze(-2) + w.unsqueeze(-1) * s
+        return y, s
+
+    @staticmethod
+    def forward(ctx, r, k, v, w, u, s, checkpoint_every):
+        T = r.size(1)
+        uu = u.view(1, *u.shape[:2])
+        y = torch.empty_like(r)
+        checkpoints = []
+        for t in range(T):
+            if t % checkpoint_every == 0:
+                checkpoints.append(s)
+            y[:, t], s = WKVFunction._step(r[:, t], k[:, t], v[:, t], w[:, t], uu, s)
+
+        ctx.checkpoint_every = checkpoint_every
+        ctx.save_for_backward(r, k, v, w, u, *checkpoints)
+        return y, s
+
+    @staticmethod
+    def backward(ctx, gy, gs):
+        r, k, v, w, u, *checkpoints = ctx.saved_tensors
+        T = r.size(1)
+        every = ctx.checkpoint_every
+        uu = u.view(1, *u.shape[:2])
+        if gy is None:
+            gy = torch.zeros_like(r)
+        if gs is None:
+            gs = torch.zeros_like(checkpoints[0])
+
+        gr = torch.empty_like(r)
+        gk = torch.empty_like(k)
+        gv = torch.empty_like(v)
+        gw = torch.empty_like(w)
+        gu = torch.zeros_like(uu)
+
+        for c in reversed(range(len(checkpoints))):
+            t0 = c * every
+            t1 = min(t0 + every, T)
+            states = [checkpoints[c]]
+            for t in range(t0, t1 - 1):
+                states.append(WKVFunction._step(r[:, t], k[:, t], v[:, t], w[:, t], uu, states[-1])[1])
+
+            for t in reversed(range(t0, t1)):
+                s = states[t - t0]
+                rt, kt, vt, gyt = r[:, t], k[:, t], v[:, t], gy[:, t]
+                rv = (gyt * vt).sum(-1, keepdim=True)
+                gr[:, t] = uu * kt * rv + torch.einsum('bhij,bhj->bhi', s, gyt)
+                gk[:, t] = rt * uu * rv + torch.einsum('bhij,bhj->bhi', gs, vt)
+                gv[:, t] = (rt * uu * kt).sum(-1, keepdim=True) * gyt + torch.einsum('bhij,bhi->bhj', gs, kt)
+                gw[:, t] = (gs * s).sum(-1)
+                gu += (rt * kt * rv).sum(0, keepdim=True)
+                gs = w[:, t].unsqueeze(-1) * gs + rt.unsqueeze(-1) * gyt.unsqueeze(-2)
+
+        return gr, gk, gv, gw, gu.view_as(u), gs, None
+
+
+def wkv_checkpointed(r, k, v, w, u, s, checkpoint_every=16):
+    """Memory-lean recurrence, see WKVFunction"""
+    return WKVFunction.apply(r, k, v, w, u, s, checkpoint_every)
+
+
+def run_wkv(args, r, k, v, w, u, s):
+    """Dispatch on args.wkv_mode ("recurrent", "chunked" or "checkpoint")"""
+    mode = getattr(args, 'wkv_mode', 'recurrent')
+    if mode == 'recurrent':
+        return wkv_recurrent(r, k, v, w, u, s)
+    if mode == 'chunked':
+        return wkv_chunked(r, k, v, w, u, s, chunk_size=getattr(args, 'wkv_chunk_size', 16), safe=getattr(args, 'wkv_chunk_safe', None))
+    if mode == 'checkpoint':
+        return wkv_checkpointed(r, k, v, w, u, s, checkpoint_every=getattr(args, 'wkv_checkpoint_every', 16))
+    raise ValueError(f'unknown wkv_mode {mode!r}')
+
+
+if __name__ == '__main__':
+    # gradcheck the hand-written backward, then compare it with autograd
+    # through the reference recurrence
+    torch.manual_seed(0)
+    B, T, H, S = 2, 7, 2, 4
+    r, k, v = torch.randn(3, B, T, H, S, dtype=torch.double).unbind(0)
+    w = torch.exp(-torch.exp(torch.randn(B, T, H, S, dtype=torch.double)))
+    u = torch.randn(H, S, 1, dtype=torch.double)
+    s = torch.randn(B, H, S, S, dtype=torch.double)
+    inputs = [x.requires_grad_() for x in (r, k, v, w, u, s)]
+
+    for every in (1, 3, T):
+        assert torch.autograd.gradcheck(lambda *a: wkv_checkpointed(*a, checkpoint_every=every), inputs)
+
+    def grads(fn):
+        y, s_out = fn(*inputs)
+        return torch.autograd.grad((y.sin().sum() + s_out.cos().sum()), inputs)
+
+    for ref, got in zip(grads(wkv_recurrent), grads(lambda *a: wkv_checkpointed(*a, checkpoint_every=3))):
+        assert torch.allclose(ref, got), (ref - got).abs().max()
+    print('wkv gradcheck ok')